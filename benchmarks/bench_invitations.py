@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Scaling benchmarks for the invitation container, queries and mutations.
+
+Each database size is filled in a fresh in-memory ZODB (``MappingStorage``
+or a ``DemoStorage`` over it) with invitations spread over sites, senders
+and receivers. The intid utility, the invitations catalog and the
+invitations container are registered globally, and the container events
+(un)index the invitations like the intid and catalog subscribers of an
+application would. Results are written as JSON, one record per size and
+operation::
+
+    python benchmarks/bench_invitations.py --sizes 10000,100000 -o out.json
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import gc
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+
+import BTrees
+
+from persistent.interfaces import IPersistent
+
+import transaction
+
+from ZODB.DB import DB
+
+from ZODB.DemoStorage import DemoStorage
+
+from ZODB.MappingStorage import MappingStorage
+
+from ZODB.interfaces import IConnection
+
+from zope import component
+from zope import interface
+
+from zope.catalog.interfaces import ICatalog
+
+from zope.intid import IntIds
+
+from zope.intid.interfaces import IIntIds
+
+from zope.keyreference.interfaces import IKeyReference
+
+from zope.keyreference.persistent import connectionOfPersistent
+from zope.keyreference.persistent import KeyReferenceToPersistent
+
+from zope.lifecycleevent.interfaces import IObjectAddedEvent
+from zope.lifecycleevent.interfaces import IObjectRemovedEvent
+from zope.lifecycleevent.interfaces import IObjectModifiedEvent
+
+from nti.invitations.index import CATALOG_NAME
+
+from nti.invitations.index import create_invitations_catalog
+
+from nti.invitations.interfaces import IUserInvitation
+from nti.invitations.interfaces import IInvitationActor
+from nti.invitations.interfaces import IInvitationsContainer
+
+from nti.invitations.model import UserInvitation
+from nti.invitations.model import InvitationsContainer
+
+from nti.invitations.model import index_invitations
+from nti.invitations.model import unindex_invitations
+
+from nti.invitations.utils import accept_invitation
+from nti.invitations.utils import get_sent_invitations
+from nti.invitations.utils import has_pending_invitations
+from nti.invitations.utils import get_pending_invitations
+from nti.invitations.utils import delete_expired_invitations
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+#: Invitations added to the container per transaction while filling it
+FILL_BATCH_SIZE = 10000
+
+DAY = 86400
+
+
+@interface.implementer(IInvitationActor)
+class AcceptingActor(object):
+
+    def __init__(self, invitation, unused_user=None):
+        self.invitation = invitation
+
+    def accept(self, unused_user, unused_invitation):
+        return True
+
+
+@component.adapter(IUserInvitation, IObjectAddedEvent)
+def _index_added(invitation, unused_event):
+    index_invitations((invitation,))
+
+
+@component.adapter(IUserInvitation, IObjectRemovedEvent)
+def _unindex_removed(invitation, unused_event):
+    unindex_invitations((invitation,))
+
+
+@component.adapter(IUserInvitation, IObjectModifiedEvent)
+def _reindex_modified(invitation, unused_event):
+    # accepting notifies a modified event; keep the catalog up to date
+    # so that the accept timings include the reindexing
+    index_invitations((invitation,))
+
+
+class Fixture(object):
+    """
+    An in-memory database with the invitation utilities registered in
+    the global site manager.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        storage = MappingStorage()
+        if args.storage == 'demo':
+            storage = DemoStorage(base=storage)
+        self.db = DB(storage)
+        self.conn = self.db.open()
+        root = self.conn.root()
+        self.intids = root['intids'] = IntIds(family=BTrees.family64)
+        self.catalog = root['catalog'] = create_invitations_catalog()
+        self.container = root['container'] = InvitationsContainer()
+        transaction.commit()
+        self.registrations = (
+            (self.intids, IIntIds, u''),
+            (self.catalog, ICatalog, CATALOG_NAME),
+            (self.container, IInvitationsContainer, u''),
+        )
+        gsm = component.getGlobalSiteManager()
+        for utility, provided, name in self.registrations:
+            gsm.registerUtility(utility, provided, name)
+        gsm.registerAdapter(KeyReferenceToPersistent, (IPersistent,), IKeyReference)
+        gsm.registerAdapter(connectionOfPersistent, (IPersistent,), IConnection)
+        gsm.registerAdapter(AcceptingActor, (IUserInvitation,), IInvitationActor)
+        gsm.registerHandler(_index_added)
+        gsm.registerHandler(_unindex_removed)
+        gsm.registerHandler(_reindex_modified)
+
+    def close(self):
+        transaction.abort()
+        gsm = component.getGlobalSiteManager()
+        for utility, provided, name in self.registrations:
+            gsm.unregisterUtility(utility, provided, name)
+        gsm.unregisterAdapter(KeyReferenceToPersistent, (IPersistent,), IKeyReference)
+        gsm.unregisterAdapter(connectionOfPersistent, (IPersistent,), IConnection)
+        gsm.unregisterAdapter(AcceptingActor, (IUserInvitation,), IInvitationActor)
+        gsm.unregisterHandler(_index_added)
+        gsm.unregisterHandler(_unindex_removed)
+        gsm.unregisterHandler(_reindex_modified)
+        self.conn.close()
+        self.db.close()
+
+    def make_invitation(self, rnd, now):
+        args = self.args
+        site = u'site%d' % rnd.randrange(args.sites)
+        sender = u'sender%d' % rnd.randrange(args.senders)
+        receiver = u'receiver%d' % rnd.randrange(args.receivers)
+        kind = rnd.random()
+        if kind < 0.2:
+            expiry = 0  # never expires
+        elif kind < 0.4:
+            expiry = now - rnd.randrange(1, 30) * DAY
+        else:
+            expiry = now + rnd.randrange(1, 30) * DAY
+        result = UserInvitation(receiver=receiver,
+                                sender=sender,
+                                site=site,
+                                expiryTime=expiry)
+        if rnd.random() < 0.5:
+            result.sent = now - rnd.randrange(1, 30) * DAY
+        if rnd.random() < 0.1:
+            result.acceptedTime = now - rnd.randrange(1, 30) * DAY
+        return result
+
+    def fill(self, size, rnd, now):
+        """
+        Fill the container with ``size`` invitations and return the
+        (site, receiver, sender) of a pending one, so that the queries
+        are measured for values that are known to match.
+        """
+        probe = None
+        remaining = size
+        while remaining > 0:
+            batch = [self.make_invitation(rnd, now)
+                     for _ in range(min(remaining, FILL_BATCH_SIZE))]
+            if probe is None:
+                for invitation in batch:
+                    if      invitation.acceptedTime is None \
+                        and (not invitation.expiryTime or invitation.expiryTime > now):
+                        probe = (invitation.site,
+                                 invitation.receiver,
+                                 invitation.sender)
+                        break
+            self.container.add_many(batch, event=False)
+            transaction.commit()
+            remaining -= len(batch)
+        # start the measurements from a cold cache
+        self.conn.cacheMinimize()
+        return probe
+
+
+def measure(func, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.time()
+        result = func()
+        timings.append(time.time() - start)
+    size = len(result) if hasattr(result, '__len__') else result
+    return timings, size
+
+
+def record(results, size, operation, timings, result_size=None):
+    entry = {
+        'size': size,
+        'operation': operation,
+        'repeat': len(timings),
+        'min': min(timings),
+        'max': max(timings),
+        'mean': sum(timings) / len(timings),
+        'result_size': result_size,
+    }
+    results.append(entry)
+    print('%10d %-28s %10.6f %10.6f %10.6f %s'
+          % (size, operation, entry['min'], entry['mean'], entry['max'],
+             '' if result_size is None else result_size),
+          file=sys.stderr)
+
+
+def run_size(size, args):
+    results = []
+    rnd = random.Random(args.seed)
+    now = time.time()
+    fixture = Fixture(args)
+    try:
+        start = time.time()
+        probe = fixture.fill(size, rnd, now)
+        if probe is None:
+            raise ValueError("No pending invitation among %s" % size)
+        record(results, size, 'fill', [time.time() - start], size)
+
+        def add():
+            fixture.container.add(fixture.make_invitation(rnd, now))
+        timings, _ = measure(add, args.repeat)
+        transaction.commit()
+        record(results, size, 'InvitationsContainer.add', timings)
+
+        sites, receivers, senders = ([x] for x in probe)
+        for name, func in (
+                ('get_pending_invitations',
+                 lambda: get_pending_invitations(receivers, sites=sites)),
+                ('get_pending_invitations/site',
+                 lambda: get_pending_invitations(sites=sites)),
+                ('has_pending_invitations',
+                 lambda: int(has_pending_invitations(receivers, sites=sites))),
+                ('get_sent_invitations',
+                 lambda: get_sent_invitations(senders, sites=sites))):
+            fixture.conn.cacheMinimize()
+            timings, result_size = measure(func, args.repeat)
+            if not result_size:
+                # the probe invitation matches all these queries
+                raise AssertionError("%s found no invitations for %s"
+                                     % (name, probe))
+            record(results, size, name, timings, result_size)
+
+        pending = get_pending_invitations(sites=sites)[:args.repeat]
+        if pending:
+            invitations = iter(pending)
+            timings, _ = measure(
+                lambda: accept_invitation(u'receiver', next(invitations)),
+                len(pending))
+            transaction.commit()
+            record(results, size, 'accept_invitation', timings)
+
+        # destructive, run last and once
+        fixture.conn.cacheMinimize()
+        timings, result_size = measure(
+            lambda: delete_expired_invitations(sites=sites, now=now), 1)
+        transaction.commit()
+        record(results, size, 'delete_expired_invitations', timings, result_size)
+    finally:
+        fixture.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes',
+                        default=','.join(str(x) for x in DEFAULT_SIZES),
+                        help='Comma separated number of invitations to fill')
+    parser.add_argument('--sites', type=int, default=50)
+    parser.add_argument('--senders', type=int, default=1000)
+    parser.add_argument('--receivers', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--storage', choices=('mapping', 'demo'),
+                        default='mapping')
+    parser.add_argument('-o', '--output', default='-',
+                        help='Output JSON file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in (int(x) for x in args.sizes.split(',') if x):
+        results.extend(run_size(size, args))
+
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'storage': args.storage,
+        'sites': args.sites,
+        'senders': args.senders,
+        'receivers': args.receivers,
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
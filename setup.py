@@ -64,8 +64,11 @@ setup(
         'nti.site',
         'nti.wref',
         'nti.zope_catalog',
+        'persistent',
         'six',
+        'transaction',
         'z3c.schema',
+        'ZODB',
         'zope.annotation',
         'zope.cachedescriptors',
         'zope.catalog',
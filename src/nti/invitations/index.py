@@ -8,9 +8,17 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import time
+import threading
+from datetime import datetime
+from collections import OrderedDict
+
 import BTrees
 
+from BTrees.Length import Length
+
 from zope import component
+from zope import interface
 
 from zope.catalog.interfaces import ICatalog
 
@@ -20,6 +28,7 @@ from zope.location import locate
 
 from nti.invitations.interfaces import IInvitation
 from nti.invitations.interfaces import IActionableInvitation
+from nti.invitations.interfaces import IInvitationsQueryCache
 
 from nti.zope_catalog.catalog import Catalog
 
@@ -52,9 +61,21 @@ IX_MIMETYPE = 'mimeType'
 #: Invitation expiry time
 IX_EXPIRYTIME = 'expiryTime'
 
+#: Invitation effective expiry time
+IX_EFFECTIVE_EXPIRYTIME = 'effectiveExpiryTime'
+
 #: Invitation created time
 IX_CREATEDTIME = 'createdTime'
 
+#: Invitation accepted time
+IX_ACCEPTEDTIME = 'acceptedTime'
+
+#: Invitation sent time
+IX_SENTTIME = 'sent'
+
+#: Effective expiry time of the invitations that never expire
+NEVER_EXPIRES = time.mktime(datetime.max.timetuple())
+
 logger = __import__('logging').getLogger(__name__)
 
 
@@ -143,6 +164,28 @@ def CreatedTimeIndex(family=BTrees.family64):
                                 normalizer=TimestampToNormalized64BitIntNormalizer())
 
 
+class AcceptedTimeRawIndex(RawIntegerValueIndex):
+    pass
+
+
+def AcceptedTimeIndex(family=BTrees.family64):
+    return NormalizationWrapper(field_name='acceptedTime',
+                                interface=IInvitation,
+                                index=AcceptedTimeRawIndex(family=family),
+                                normalizer=TimestampToNormalized64BitIntNormalizer())
+
+
+class SentTimeRawIndex(RawIntegerValueIndex):
+    pass
+
+
+def SentTimeIndex(family=BTrees.family64):
+    return NormalizationWrapper(field_name='sent',
+                                interface=IActionableInvitation,
+                                index=SentTimeRawIndex(family=family),
+                                normalizer=TimestampToNormalized64BitIntNormalizer())
+
+
 class ExpiryTimeRawIndex(RawIntegerValueIndex):
     pass
 
@@ -154,25 +197,491 @@ def ExpiryTimeIndex(family=BTrees.family64):
                                 normalizer=TimestampToNormalized64BitIntNormalizer())
 
 
-class InvitationsCatalog(Catalog):
+class ValidatingEffectiveExpiryTime(object):
+    """
+    Maps an expiry time of zero (never expires) to :data:`NEVER_EXPIRES`
+    so that pending invitations can be found with a single range query.
+    """
+
+    __slots__ = ('effectiveExpiryTime',)
+
+    def __init__(self, obj=None, unused_default=None):
+        if IActionableInvitation.providedBy(obj):
+            self.effectiveExpiryTime = obj.expiryTime or NEVER_EXPIRES
+
+    def __reduce__(self):
+        raise TypeError()
+
+
+class EffectiveExpiryTimeRawIndex(RawIntegerValueIndex):
     pass
 
 
+def EffectiveExpiryTimeIndex(family=BTrees.family64):
+    return NormalizationWrapper(field_name='effectiveExpiryTime',
+                                interface=ValidatingEffectiveExpiryTime,
+                                index=EffectiveExpiryTimeRawIndex(family=family),
+                                normalizer=TimestampToNormalized64BitIntNormalizer())
+
+
+class MissingIndexError(LookupError):
+    """
+    Raised when a query needs an index the invitations catalog does not
+    have, e.g. a catalog installed before the index was introduced, or
+    that is still being built.
+    """
+
+    def __init__(self, name):
+        super(MissingIndexError, self).__init__(
+            "The invitations catalog has no ready %r index" % name)
+        self.name = name
+
+
+def filter_doc_ids(index, index_query, doc_ids, family=BTrees.family64):
+    """
+    Return the ``doc_ids`` matching ``index_query`` on the given value index
+    by checking the indexed value of each document, which is cheaper than
+    applying the query when there are few documents.
+
+    Only ``any_of`` and ``between`` queries are supported; for anything
+    else None is returned.
+    """
+    raw = getattr(index, 'index', index)
+    documents_to_values = getattr(raw, 'documents_to_values', None)
+    if     documents_to_values is None \
+        or not isinstance(index_query, dict) \
+        or len(index_query) != 1:
+        return None
+    op, query = list(index_query.items())[0]
+    normalizer = getattr(index, 'normalizer', None)
+    if op == 'any_of':
+        values = set()
+        for value in query:
+            if normalizer is not None:
+                # normalizers return the sequence of matching values
+                values.update(normalizer.any(value, raw))
+            else:
+                values.add(value)
+
+        def accept(value):
+            return value in values
+    elif op == 'between':
+        query = tuple(query) + (False, False)
+        low, high, exclude_low, exclude_high = query[:4]
+        if normalizer is not None:
+            if low is not None:
+                low = normalizer.minimum(low, raw)
+            if high is not None:
+                high = normalizer.maximum(high, raw)
+
+        def accept(value):
+            if value is None:
+                return False
+            if low is not None and (value < low or (exclude_low and value == low)):
+                return False
+            if high is not None and (value > high or (exclude_high and value == high)):
+                return False
+            return True
+    else:
+        return None
+    return family.IF.Set([x for x in doc_ids
+                          if accept(documents_to_values.get(x))])
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted(((k, _freeze(v)) for k, v in value.items()),
+                            key=repr))
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted((_freeze(v) for v in value), key=repr))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+@interface.implementer(IInvitationsQueryCache)
+class InvitationsQueryCache(object):
+    """
+    A thread-safe LRU cache of query results bounded by the number
+    of entries and by the total number of cached intids.
+    """
+
+    def __init__(self, max_entries=1000, max_ids=1000000):
+        self.max_entries = max_entries
+        self.max_ids = max_ids
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._ids = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.pop(key, None)
+            if value is not None:
+                self._data[key] = value  # most recently used
+            return value
+
+    def set(self, key, value):
+        size = len(value)
+        if size > self.max_ids:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._ids -= len(old)
+            self._data[key] = value
+            self._ids += size
+            while     len(self._data) > self.max_entries \
+                   or self._ids > self.max_ids:
+                _, old = self._data.popitem(last=False)
+                self._ids -= len(old)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._ids = 0
+
+
+class InvitationsCatalog(Catalog):
+    """
+    A catalog that plans its queries and whose results can be cached
+    in the registered :class:`~nti.invitations.interfaces.IInvitationsQueryCache`.
+
+    Indexes are evaluated from the most to the least selective one as
+    estimated from their postings. Once the running result is smaller than
+    the estimate of the next index, that index filters the result document
+    by document instead of being applied, and evaluation stops as soon as
+    the result is empty.
+
+    Cache entries are keyed on the catalog generation, a conflict-free
+    counter bumped every time a document is (un)indexed. Code that updates
+    the indexes directly must call :meth:`bump_generation`. Results are
+    not cached while the generation is changed by the current transaction,
+    so every cached result belongs to a committed state.
+
+    Indexes added to an existing catalog are being built until they are
+    marked ready; queries should not rely on them before then.
+    """
+
+    _generation = None
+
+    #: The names of the indexes that are not completely filled yet
+    _building = ()
+
+    #: The number of documents of a posting counted by :meth:`plan`
+    #: before looking for more selective indexes
+    estimate_limit = 100
+
+    def __init__(self, family=None):
+        super(InvitationsCatalog, self).__init__(family=family)
+        self._generation = Length()
+
+    @property
+    def generation(self):
+        length = self._generation
+        return length() if length is not None else None
+
+    def bump_generation(self):
+        if self._generation is None:
+            self._generation = Length()
+        self._generation.change(1)
+
+    def index_doc(self, docid, texts):
+        super(InvitationsCatalog, self).index_doc(docid, texts)
+        self.bump_generation()
+
+    def unindex_doc(self, docid):
+        super(InvitationsCatalog, self).unindex_doc(docid)
+        self.bump_generation()
+
+    def clear(self):
+        super(InvitationsCatalog, self).clear()
+        self.bump_generation()
+
+    def updateIndex(self, index, *args, **kwargs):
+        super(InvitationsCatalog, self).updateIndex(index, *args, **kwargs)
+        self.bump_generation()
+        self.mark_ready((index.__name__,))
+
+    def updateIndexes(self, *args, **kwargs):
+        super(InvitationsCatalog, self).updateIndexes(*args, **kwargs)
+        self.bump_generation()
+        self.mark_ready()
+
+    def is_ready(self, name):
+        return name in self and name not in self._building
+
+    def mark_building(self, name):
+        if name not in self._building:
+            self._building += (name,)
+
+    def mark_ready(self, names=None):
+        """
+        Mark the named indexes, or all of them, as completely filled.
+        """
+        building = () if names is None \
+            else tuple(x for x in self._building if x not in names)
+        if building != self._building:
+            self._building = building
+
+    def _normalize(self, name, index_query):
+        # Normalize query values like the index will, so that
+        # equivalent queries (e.g. for close times) share a key
+        index = self.get(name)
+        normalizer = getattr(index, 'normalizer', None)
+        if normalizer is None or not isinstance(index_query, dict):
+            return index_query
+        result = dict(index_query)
+        raw = index.index
+        for op, value in index_query.items():
+            if op in ('any_of', 'all_of'):
+                result[op] = sorted(set(x for v in value
+                                        for x in normalizer.any(v, raw)),
+                                    key=repr)
+            elif op == 'between':
+                value = list(value)
+                if value[0] is not None:
+                    value[0] = normalizer.minimum(value[0], raw)
+                if value[1] is not None:
+                    value[1] = normalizer.maximum(value[1], raw)
+                result[op] = value
+        return result
+
+    def estimate(self, name, index_query, limit=None):
+        """
+        Estimate the number of documents matching ``index_query`` on the
+        named index from its postings, without computing them. Returns
+        None if the estimate is unknown.
+
+        If ``limit`` is given, counting stops once the estimate exceeds
+        it, so that only the first buckets of large postings are loaded;
+        the returned estimate is then ``limit + 1``.
+        """
+        index = self[name]
+        raw = getattr(index, 'index', index)
+        if not isinstance(index_query, dict) or len(index_query) != 1:
+            return None
+        op, values = list(index_query.items())[0]
+        values_to_documents = getattr(raw, 'values_to_documents', None)
+        if op != 'any_of' or values_to_documents is None:
+            count = getattr(raw, 'documentCount', None)
+            return count() if count is not None else None
+        normalizer = getattr(index, 'normalizer', None)
+        if normalizer is not None:
+            values = set(x for v in values for x in normalizer.any(v, raw))
+        result = 0
+        for value in values:
+            docs = values_to_documents.get(value)
+            if docs is None:
+                continue
+            if limit is None:
+                result += len(docs)
+                continue
+            # len() of a TreeSet loads all its buckets
+            for _ in docs:
+                result += 1
+                if result > limit:
+                    return result
+        return result
+
+    def plan(self, query):
+        """
+        Return the ``(estimate, index name)`` pairs of the given query in
+        the order they are evaluated, most selective first.
+
+        Postings are counted up to :attr:`estimate_limit` documents. The
+        limit is raised only while every estimate exceeds it, so broad
+        postings are never fully counted when a selective index exists.
+        """
+        estimates = {}
+        todo = sorted(query)
+        limit = self.estimate_limit
+        while todo:
+            for name in todo:
+                estimates[name] = self.estimate(name, query[name], limit)
+            known = [x for x in estimates.values() if x is not None]
+            if not known or min(known) <= limit:
+                break
+            # every estimate was cut at the limit
+            todo = [name for name, x in estimates.items() if x == limit + 1]
+            limit *= 4
+        result = [(x, name) for name, x in estimates.items()]
+        result.sort(key=lambda x: (x[0] is None, x[0] or 0, x[1]))
+        return result
+
+    def _apply(self, query, steps=None):
+        result = None
+        intersection = self.family.IF.intersection
+        for estimate, name in self.plan(query):
+            index_query = query[name]
+            start = time.time() if steps is not None else None
+            if result is not None and (estimate is None or len(result) < estimate):
+                ids = filter_doc_ids(self[name], index_query, result,
+                                     family=self.family)
+                if ids is not None:
+                    result = ids
+                    if steps is not None:
+                        steps.append(self._step(name, estimate, 'filter',
+                                                start, ids, result))
+                    if not result:
+                        break
+                    continue
+            ids = self[name].apply(index_query)
+            if ids is not None:
+                result = ids if result is None else intersection(result, ids)
+            if steps is not None:
+                steps.append(self._step(name, estimate, 'apply',
+                                        start, ids, result))
+            if not result and ids is not None:
+                break
+        return result
+
+    @staticmethod
+    def _step(name, estimate, strategy, start, ids, result):
+        return {
+            'index': name,
+            'estimate': estimate,
+            'strategy': strategy,
+            'time': time.time() - start,
+            'size': len(ids) if ids is not None else None,
+            'result_size': len(result) if result is not None else None,
+        }
+
+    def explain(self, query):
+        """
+        Evaluate ``query`` like :meth:`apply`, bypassing the query cache,
+        and return a report of how it was evaluated: the normalized query,
+        the plan, and for every evaluated index the strategy used (the
+        index is either applied or used to filter the running result),
+        the time spent, the size of the documents it produced and the
+        size of the running result. Indexes after the first empty result
+        are not evaluated.
+        """
+        steps = []
+        start = time.time()
+        result = self._apply(query, steps)
+        return {
+            'query': dict((name, self._normalize(name, value))
+                          for name, value in query.items()),
+            'plan': self.plan(query),
+            'steps': steps,
+            'time': time.time() - start,
+            'result_size': len(result) if result is not None else None,
+        }
+
+    def _cache_key(self, query):
+        length = self._generation
+        if length is None or length._p_changed:
+            return None
+        jar, oid = self._p_jar, self._p_oid
+        if jar is not None and oid is not None:
+            owner = (jar.db().database_name, oid)
+        else:
+            owner = self
+        query = dict((name, self._normalize(name, value))
+                     for name, value in query.items())
+        return (owner, length(), _freeze(query))
+
+    def apply(self, query):
+        cache = component.queryUtility(IInvitationsQueryCache)
+        if cache is None:
+            return self._apply(query)
+        # Range queries are mostly relative to the current time (e.g. the
+        # expiry of pending invitations) and would make a new key on every
+        # call. Only the rest of the query is cached; the ranges are
+        # applied and intersected with it.
+        ranges = [(name, value) for name, value in query.items()
+                  if isinstance(value, dict) and 'between' in value]
+        cached = dict((name, value) for name, value in query.items()
+                      if (name, value) not in ranges)
+        key = self._cache_key(cached) if cached else None
+        if key is None:
+            return self._apply(query)
+        result = cache.get(key)
+        if result is None:
+            result = self._apply(cached)
+            if result is None:
+                return self._apply(query)
+            cache.set(key, result)
+        intersection = self.family.IF.intersection
+        copied = False
+        for name, index_query in ranges:
+            if not result:
+                break
+            ids = self[name].apply(index_query)
+            if ids is not None:
+                # a new set, the cached one is left untouched
+                result = intersection(result, ids)
+                copied = True
+        if not copied:
+            # callers may change the result
+            result = self.family.IF.Set(result)
+        return result
+
+
+#: The ``(name, factory)`` pairs of the invitations catalog indexes
+INVITATIONS_INDEXES = (
+    (IX_SITE, SiteIndex),
+    (IX_SENDER, SenderIndex),
+    (IX_ACCEPTED, AcceptedIndex),
+    (IX_MIMETYPE, MimeTypeIndex),
+    (IX_RECEIVER, ReceiverIndex),
+    (IX_EXPIRYTIME, ExpiryTimeIndex),
+    (IX_EFFECTIVE_EXPIRYTIME, EffectiveExpiryTimeIndex),
+    (IX_CREATEDTIME, CreatedTimeIndex),
+    (IX_ACCEPTEDTIME, AcceptedTimeIndex),
+    (IX_SENTTIME, SentTimeIndex),
+)
+
+
 def create_invitations_catalog(catalog=None, family=BTrees.family64):
     catalog = InvitationsCatalog(family=family) if catalog is None else catalog
-    for name, clazz in ((IX_SITE, SiteIndex),
-                        (IX_SENDER, SenderIndex),
-                        (IX_ACCEPTED, AcceptedIndex),
-                        (IX_MIMETYPE, MimeTypeIndex),
-                        (IX_RECEIVER, ReceiverIndex),
-                        (IX_EXPIRYTIME, ExpiryTimeIndex),
-                        (IX_CREATEDTIME, CreatedTimeIndex)):
+    for name, clazz in INVITATIONS_INDEXES:
         index = clazz(family=family)
         locate(index, catalog, name)
         catalog[name] = index
     return catalog
 
 
+def add_missing_indexes(catalog, names=None, intids=None):
+    """
+    Add the empty invitations indexes, restricted to ``names`` if given,
+    that the given catalog does not have, registering them with
+    ``intids`` if given. The new indexes must then be filled, e.g. with
+    :func:`nti.invitations.model.reindex_invitations`; until then they
+    are not ready in an :class:`InvitationsCatalog`.
+
+    :return: The names of the added indexes.
+    """
+    result = []
+    for name, clazz in INVITATIONS_INDEXES:
+        if name in catalog or (names is not None and name not in names):
+            continue
+        index = clazz(family=catalog.family)
+        locate(index, catalog, name)
+        # add directly, the catalog would index all the intids
+        # pylint: disable=protected-access
+        catalog._setitemf(name, index)
+        if isinstance(catalog, InvitationsCatalog):
+            catalog.mark_building(name)
+        if intids is not None:
+            intids.register(index)
+        result.append(name)
+    return result
+
+
+def index_ready(catalog, name):
+    """
+    Return whether the given catalog has the named index and it is
+    completely filled, so that queries can use it.
+    """
+    if isinstance(catalog, InvitationsCatalog):
+        return catalog.is_ready(name)
+    return name in catalog
+
+
 def get_invitations_catalog(registry=component):
     return registry.queryUtility(ICatalog, name=CATALOG_NAME)
 
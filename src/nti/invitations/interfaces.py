@@ -167,6 +167,29 @@ class IInvitationsContainer(IContained,
         """
     removeInvitation = remove
 
+    def add_many(invitations, event=True):
+        """
+        Registers all the given invitations with this object, assigning the missing
+        codes in one pass.
+
+        :param event: If false, no per-invitation events are fired. The invitations
+            are instead registered with the intid utility and indexed in the
+            invitations catalog in bulk, and a single
+            :class:`IInvitationsAddedEvent` is notified.
+        :raises DuplicateInvitationCodeError: If a code is already in use; no
+            invitation is added in that case.
+        """
+
+    def remove_many(invitations):
+        """
+        Remove the given invitations or invitation codes from this object in
+        bulk. No per-invitation events are fired; the invitations are instead
+        unindexed from the invitations catalog and unregistered from the intid
+        utility, and a single :class:`IInvitationsRemovedEvent` is notified.
+
+        :return: The removed invitations.
+        """
+
     def get_invitation_by_code(code):
         """
         Returns an invitation having the given code, or None if there is no
@@ -174,10 +197,110 @@ class IInvitationsContainer(IContained,
         """
     getInvitationByCode = get_invitation_by_code
 
+    def keys_after(code=None):
+        """
+        Iterate the invitation codes in case-insensitive order, starting
+        right after ``code`` if given.
+        """
+
 
 IInvitations = IInvitationsContainer  # BWC
 
 
+class IInvitationCodeAllocator(interface.Interface):
+    """
+    A utility that allocates unique invitation codes. When one is
+    registered, containers use it to assign the missing codes without
+    checking them against the container.
+    """
+
+    def allocate():
+        """
+        Return a new invitation code that has never been returned before,
+        by this or any other process.
+        """
+
+
+class IInvitationsQueryCache(interface.Interface):
+    """
+    An in-memory cache of invitations catalog query results. When one is
+    registered, the invitations catalog stores and looks up its query
+    results in it.
+    """
+
+    def get(key):
+        """
+        Return the result cached under ``key`` or None.
+        """
+
+    def set(key, value):
+        """
+        Cache the given result under ``key``.
+        """
+
+    def clear():
+        """
+        Remove all the cached results.
+        """
+
+
+class IInvitationsStatistics(interface.Interface):
+    """
+    Invitation totals by state, overall, per site and per sender, kept
+    up to date by event subscribers. Intended to be used as a persistent
+    utility registered for the site.
+
+    Expiry depends on the time the question is asked, so expired
+    invitations are not counted here; ask the catalog for those.
+    """
+
+    def change(invitation, state, delta=1):
+        """
+        Change the ``state`` totals of the site and sender of the given
+        invitation by ``delta``.
+        """
+
+    def count(state, site=None, sender=None):
+        """
+        Return the number of invitations in the given state, optionally
+        restricted to a site and/or a sender.
+        """
+
+    def counts(site=None, sender=None):
+        """
+        Return a dictionary with the totals of every state, optionally
+        restricted to a site and/or a sender.
+        """
+
+    def clear():
+        """
+        Reset all the totals.
+        """
+
+
+class IInvitationsMetrics(interface.Interface):
+    """
+    A utility that receives the counts and timings reported by the
+    invitation queries and containers, to forward them to a metrics
+    backend. The default registered utility does nothing.
+    """
+
+    def incr(name, value=1):
+        """
+        Increment the counter ``name`` by ``value``.
+        """
+
+    def timing(name, seconds):
+        """
+        Record that the operation ``name`` took ``seconds``.
+        """
+
+    def observe(name, value):
+        """
+        Record a measured ``value``, such as a result size, for ``name``.
+        """
+
+
 class IInvitationEvent(IObjectEvent):
     """
     An event specifically about an invitation.
@@ -205,19 +328,57 @@ class InvitationSentEvent(ObjectEvent):
         return self.doc()
 
 
+class IInvitationsAddedEvent(IObjectEvent):
+    """
+    Invitations have been added in bulk to an :class:`IInvitationsContainer`
+    without per-invitation events.
+    """
+    object = Object(IInvitationsContainer, title=u"The container.")
+    invitations = interface.Attribute("The added invitations.")
+
+
+@interface.implementer(IInvitationsAddedEvent)
+class InvitationsAddedEvent(ObjectEvent):
+
+    def __init__(self, obj, invitations):
+        super(InvitationsAddedEvent, self).__init__(obj)
+        self.invitations = invitations
+
+
+class IInvitationsRemovedEvent(IObjectEvent):
+    """
+    Invitations have been removed in bulk from an :class:`IInvitationsContainer`
+    without per-invitation events.
+    """
+    object = Object(IInvitationsContainer, title=u"The container.")
+    invitations = interface.Attribute("The removed invitations.")
+
+
+@interface.implementer(IInvitationsRemovedEvent)
+class InvitationsRemovedEvent(ObjectEvent):
+
+    def __init__(self, obj, invitations):
+        super(InvitationsRemovedEvent, self).__init__(obj)
+        self.invitations = invitations
+
+
 class IInvitationAcceptedEvent(IObjectModifiedEvent, IInvitationEvent):
     """
     An invitation has been accepted.
     """
     user = interface.Attribute("The user that accepted the invitation.")
 
+    was_accepted = interface.Attribute(
+        "Whether the invitation had already been accepted before.")
+
 
 @interface.implementer(IInvitationAcceptedEvent)
 class InvitationAcceptedEvent(ObjectModifiedEvent):
 
-    def __init__(self, obj, user):
+    def __init__(self, obj, user, was_accepted=False):
         super(InvitationAcceptedEvent, self).__init__(obj)
         self.user = user
+        self.was_accepted = was_accepted
 
 
 class DuplicateInvitationCodeError(ValidationError):
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Metric names and helpers to report them to the registered
+:class:`~nti.invitations.interfaces.IInvitationsMetrics` utility.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+from contextlib import contextmanager
+
+from zope import component
+from zope import interface
+
+from nti.invitations.interfaces import IInvitationsMetrics
+
+#: Prefix of the catalog query timings, followed by the query kind
+#: (``pending``, ``accepted``, ``expired``, ...). The result sizes are
+#: observed under the same name followed by ``.size``.
+METRIC_QUERY = 'invitations.query'
+
+#: Invitation objects loaded from the database while resolving intids
+METRIC_OBJECTS_ACTIVATED = 'invitations.objects.activated'
+
+#: Resolved objects dropped because they are not actionable invitations
+METRIC_OBJECTS_FILTERED = 'invitations.objects.filtered'
+
+#: Prefix of the container operation timings and counts, followed by
+#: the operation (``add``, ``remove``)
+METRIC_CONTAINER = 'invitations.container'
+
+#: Time spent accepting an invitation
+METRIC_ACCEPT = 'invitations.accept'
+
+#: Invitations accepted
+METRIC_ACCEPTED = 'invitations.accepted'
+
+#: Prefix of the expired invitation removal timings, followed by the
+#: operation (``delete``, ``sweep``), and of the count of the removed
+#: invitations (``removed``)
+METRIC_EXPIRED = 'invitations.expired'
+
+logger = __import__('logging').getLogger(__name__)
+
+
+@interface.implementer(IInvitationsMetrics)
+class NullInvitationsMetrics(object):
+    """
+    Metrics that go nowhere.
+    """
+
+    def incr(self, name, value=1):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+
+NULL_METRICS = NullInvitationsMetrics()
+
+
+def get_invitations_metrics():
+    result = component.queryUtility(IInvitationsMetrics)
+    return NULL_METRICS if result is None else result
+
+
+@contextmanager
+def timed(name, metrics=None):
+    """
+    Report the time spent in the ``with`` block as ``name``. The metrics
+    utility is the value of the block.
+    """
+    metrics = get_invitations_metrics() if metrics is None else metrics
+    start = time.time()
+    try:
+        yield metrics
+    finally:
+        metrics.timing(name, time.time() - start)
+
+
+def query_timed(kind):
+    return timed('%s.%s' % (METRIC_QUERY, kind))
+
+
+def observe_size(metrics, kind, result):
+    metrics.observe('%s.%s.size' % (METRIC_QUERY, kind),
+                    len(result) if result else 0)
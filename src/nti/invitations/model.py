@@ -9,10 +9,22 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 import time
+import zlib
+import heapq
+import numbers
+from itertools import islice
+from itertools import dropwhile
 from functools import total_ordering
 
 from z3c.schema.email.field import isValidMailAddress
 
+from persistent import Persistent
+
+import transaction
+
+from ZODB.POSException import ConflictError
+
+from zope import component
 from zope import interface
 
 from zope.annotation.interfaces import IAttributeAnnotatable
@@ -23,6 +35,8 @@ from zope.component.hooks import getSite
 
 from zope.container.contained import Contained
 
+from zope.event import notify
+
 from zope.intid.interfaces import IIntIds
 
 from zope.mimetype.interfaces import IContentTypeAware
@@ -35,10 +49,24 @@ from nti.dublincore.datastructures import PersistentCreatedModDateTrackingObject
 
 from nti.externalization.representation import WithRepr
 
+from nti.invitations.index import InvitationsCatalog
+
+from nti.invitations.index import add_missing_indexes
+from nti.invitations.index import get_invitations_catalog
+
 from nti.invitations.interfaces import IUserInvitation
+from nti.invitations.interfaces import InvitationsAddedEvent
 from nti.invitations.interfaces import IInvitationsContainer
+from nti.invitations.interfaces import InvitationsRemovedEvent
+from nti.invitations.interfaces import IInvitationCodeAllocator
 from nti.invitations.interfaces import DuplicateInvitationCodeError
 
+from nti.invitations.metrics import METRIC_CONTAINER
+
+from nti.invitations.metrics import timed
+
+from nti.invitations.utils import DEFAULT_BATCH_SIZE
+
 from nti.invitations.utils import get_random_invitation_code
 
 from nti.property.property import alias
@@ -53,6 +81,8 @@ SYSTEM_USER_NAME = getattr(system_user, 'title').lower()
 
 logger = __import__('logging').getLogger(__name__)
 
+_marker = object()
+
 
 @WithRepr
 @EqHash('code')
@@ -81,11 +111,9 @@ class UserInvitation(PersistentCreatedModDateTrackingObject,
 
     @readproperty
     def site(self):  # pylint: disable=method-hidden
-        result = getattr(getSite(), '__name__', None)
-        if result:
-            # save value as soon as the property is read
-            self.site = result
-        return result
+        # Never write on read; the site is pinned when
+        # the invitation is added to a container
+        return getattr(getSite(), '__name__', None)
 
     @property
     def sender(self):
@@ -115,6 +143,37 @@ class UserInvitation(PersistentCreatedModDateTrackingObject,
     def accepted(self):
         return self.acceptedTime is not None
 
+    #: Timestamps that keep their latest value when concurrent
+    #: transactions set them. The modification time is not in the
+    #: state; it lives in its own mergeable ``NumericMaximum`` object.
+    _p_max_merged = ('sent', 'acceptedTime')
+
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        # Merge concurrent changes to disjoint attributes, e.g. the
+        # sent time being set while the invitation is accepted
+        if not all(isinstance(x, dict) for x in (oldState, savedState, newState)):
+            raise ConflictError()
+        result = dict()
+        for key in set(oldState).union(savedState, newState):
+            old = oldState.get(key, _marker)
+            saved = savedState.get(key, _marker)
+            new = newState.get(key, _marker)
+            if saved == new or new == old:
+                value = saved
+            elif saved == old:
+                value = new
+            elif     key in self._p_max_merged \
+                 and saved is not _marker and new is not _marker:
+                values = [x for x in (saved, new) if x is not None]
+                if not all(isinstance(x, numbers.Number) for x in values):
+                    raise ConflictError()
+                value = max(values) if values else None
+            else:
+                raise ConflictError()
+            if value is not _marker:
+                result[key] = value
+        return result
+
     def __lt__(self, other):
         try:
             return (self.code, self.createdTime) < (other.code, other.createdTime)
@@ -126,45 +185,468 @@ class UserInvitation(PersistentCreatedModDateTrackingObject,
 Invitation = UserInvitation
 
 
+def pin_site(invitation, site_name=None):
+    """
+    Store the site of the given invitation, by default the name of the
+    current site, unless it already has one.
+
+    :return: True if the invitation was changed.
+    """
+    if not IUserInvitation.providedBy(invitation):
+        return False
+    invitation._p_activate()  # pylint: disable=protected-access
+    if invitation.__dict__.get('site'):
+        return False
+    site_name = site_name or getattr(getSite(), '__name__', None)
+    if not site_name:
+        return False
+    invitation.site = site_name
+    return True
+
+
+def allocate_invitation_code(container, reserved=()):
+    """
+    Return a new code for an invitation of the given container, not
+    in ``reserved`` (lowercase codes). Codes come from the registered
+    :class:`IInvitationCodeAllocator`, if any, which guarantees they are
+    unique; otherwise random codes are drawn until one is unused.
+    """
+    allocator = component.queryUtility(IInvitationCodeAllocator)
+    if allocator is not None:
+        return allocator.allocate()
+    code = get_random_invitation_code()
+    while code in container or code.lower() in reserved:
+        code = get_random_invitation_code()
+    return code
+
+
+def prepare_invitations(container, invitations):
+    """
+    Check that the codes of the given invitations are not used in the
+    container, assign the missing codes and pin the sites.
+
+    :return: The invitations sorted by code.
+    """
+    invitations = list(invitations)
+    # validate before changing anything
+    reserved = set()
+    for invitation in invitations:
+        code = invitation.code
+        if code and (code in container or code.lower() in reserved):
+            raise DuplicateInvitationCodeError(code)
+        elif code:
+            reserved.add(code.lower())
+    for invitation in invitations:
+        if not invitation.code:
+            invitation.code = allocate_invitation_code(container, reserved)
+            reserved.add(invitation.code.lower())
+        pin_site(invitation)
+    # sorted keys land in neighboring buckets
+    invitations.sort(key=lambda x: x.code.lower())
+    return invitations
+
+
 @interface.implementer(IInvitationsContainer, IAttributeAnnotatable)
 class InvitationsContainer(CaseInsensitiveLastModifiedBTreeContainer,
                            Contained):
 
+    def _add(self, invitation, check=True):
+        with timed('%s.add' % METRIC_CONTAINER) as metrics:
+            code = invitation.code
+            if not code:
+                code = allocate_invitation_code(self)
+                invitation.code = code
+            elif check and code in self:
+                raise DuplicateInvitationCodeError(code)
+            self[code] = invitation
+        metrics.incr('%s.added' % METRIC_CONTAINER)
+
     def add(self, invitation):
-        code = invitation.code
-        if not code:
-            code = get_random_invitation_code()
-            while code in self:
-                code = get_random_invitation_code()
-            invitation.code = code
-        if code in self:
-            raise DuplicateInvitationCodeError(code)
-        self[code] = invitation
+        self._add(invitation)
     registerInvitation = append = add
 
+    def add_many(self, invitations, event=True):
+        with timed('%s.add_many' % METRIC_CONTAINER) as metrics:
+            invitations = prepare_invitations(self, invitations)
+            if event:
+                for invitation in invitations:
+                    self[invitation.code] = invitation
+            else:
+                for invitation in invitations:
+                    invitation.__parent__ = self
+                    self._setitemf(invitation.code, invitation)
+                self.updateLastMod()
+                index_invitations(invitations)
+                notify(InvitationsAddedEvent(self, invitations))
+        metrics.incr('%s.added' % METRIC_CONTAINER, len(invitations))
+        return invitations
+    registerInvitations = add_many
+
     def remove(self, invitation, event=True):
         result = False
         code = getattr(invitation, 'code', invitation)
-        if code in self:
-            if event:
-                del self[code]
-            else:
-                self._delitemf(code, False)
-            result = True
+        with timed('%s.remove' % METRIC_CONTAINER) as metrics:
+            if code in self:
+                if event:
+                    del self[code]
+                else:
+                    self._delitemf(code, False)
+                result = True
+        if result:
+            metrics.incr('%s.removed' % METRIC_CONTAINER)
         return result
     removeInvitation = remove
 
+    def _remove_many(self, invitations):
+        """
+        Remove the given invitations or codes, returning the
+        ``(lowercase code, invitation)`` pairs of the removed ones in
+        code order.
+        """
+        codes = set()
+        for invitation in invitations:
+            code = getattr(invitation, 'code', invitation)
+            if code:
+                codes.add(code)
+        result = []
+        with timed('%s.remove_many' % METRIC_CONTAINER) as metrics:
+            for code in sorted(codes, key=lambda x: x.lower()):
+                invitation = self.get(code)
+                if invitation is not None:
+                    self._delitemf(code, False)
+                    result.append((code.lower(), invitation))
+            removed = [x for _, x in result]
+            if removed:
+                self.updateLastMod()
+                unindex_invitations(removed)
+                # like uncontained, the name is the code
+                for invitation in removed:
+                    invitation.__parent__ = None
+                    invitation.__name__ = None
+                notify(InvitationsRemovedEvent(self, removed))
+        metrics.incr('%s.removed' % METRIC_CONTAINER, len(removed))
+        return result
+
+    def remove_many(self, invitations):
+        return [x for _, x in self._remove_many(invitations)]
+    removeInvitations = remove_many
+
     def get_invitation_by_code(self, code):
         return self.get(code)
     getInvitationByCode = get_invitation_by_code
 
+    def keys_after(self, code=None):
+        """
+        Iterate the codes in code order, starting right after ``code``
+        if given, without loading the codes before it.
+        """
+        if code is None:
+            return iter(self.keys())
+        # the keys are ordered case-insensitively, starting at ``code``
+        last = code.lower()
+        return dropwhile(lambda x: x.lower() == last, self.keys(code))
+
+    def __setitem__(self, key, value):
+        # every way in goes through here or prepare_invitations
+        pin_site(value)
+        super(InvitationsContainer, self).__setitem__(key, value)
+
+
+@interface.implementer(IInvitationsContainer, IAttributeAnnotatable)
+class ShardedInvitationsContainer(Persistent, Contained):
+    """
+    An invitations container that spreads the invitations over a fixed
+    number of :class:`InvitationsContainer` shards by a stable hash of
+    their code, so that concurrent writes seldom touch the same BTree.
+
+    Invitations are contained in their shard, which can be looked up by
+    its name with :meth:`get_shard`; the container API only deals with
+    invitation codes. Iteration merges the shards in code order.
+    """
+
+    shard_prefix = u'++shard++'
+
+    def __init__(self, shards=16):
+        self._shards = tuple(self._make_shard(x) for x in range(shards))
+
+    def _make_shard(self, number):
+        result = InvitationsContainer()
+        result.__parent__ = self
+        result.__name__ = u'%s%s' % (self.shard_prefix, number)
+        return result
+
+    def get_shard(self, name, default=None):
+        """
+        Return the shard with the given name, e.g. to resolve the path of
+        an invitation, or ``default``.
+        """
+        if name and name.startswith(self.shard_prefix):
+            number = name[len(self.shard_prefix):]
+            if number.isdigit() and int(number) < len(self._shards):
+                return self._shards[int(number)]
+        return default
+
+    @property
+    def shards(self):
+        return self._shards
+
+    def _shard_index(self, code):
+        key = code.lower()
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return (zlib.crc32(key) & 0xffffffff) % len(self._shards)
+
+    def shard_for(self, code):
+        return self._shards[self._shard_index(code)]
+
+    def _group(self, items, code=lambda x: x):
+        result = dict()
+        for item in items:
+            result.setdefault(self._shard_index(code(item)), []).append(item)
+        return [(self._shards[k], v) for k, v in sorted(result.items())]
 
-def install_invitations_container(site_manager_container, intids=None):
+    # invitations API
+
+    def add(self, invitation):
+        code = invitation.code
+        if not code:
+            code = allocate_invitation_code(self)
+            invitation.code = code
+            # allocated codes are not in use
+            # pylint: disable=protected-access
+            self.shard_for(code)._add(invitation, check=False)
+        else:
+            self.shard_for(code).add(invitation)
+    registerInvitation = append = add
+
+    def add_many(self, invitations, event=True):
+        invitations = prepare_invitations(self, invitations)
+        for shard, group in self._group(invitations, lambda x: x.code):
+            shard.add_many(group, event)
+        return invitations
+    registerInvitations = add_many
+
+    def remove(self, invitation, event=True):
+        code = getattr(invitation, 'code', invitation)
+        if not code:
+            return False
+        return self.shard_for(code).remove(code, event)
+    removeInvitation = remove
+
+    def remove_many(self, invitations):
+        codes = (getattr(x, 'code', x) for x in invitations)
+        result = []
+        for shard, group in self._group(x for x in codes if x):
+            # pylint: disable=protected-access
+            result.extend(shard._remove_many(group))
+        # the removed invitations no longer have a code
+        result.sort(key=lambda x: x[0])
+        return [x for _, x in result]
+    removeInvitations = remove_many
+
+    def get_invitation_by_code(self, code):
+        return self.get(code)
+    getInvitationByCode = get_invitation_by_code
+
+    # container API
+
+    def __getitem__(self, key):
+        return self.shard_for(key)[key]
+
+    def get(self, key, default=None):
+        if not key:
+            return default
+        return self.shard_for(key).get(key, default)
+
+    def __contains__(self, key):
+        return bool(key) and key in self.shard_for(key)
+
+    def __setitem__(self, key, value):
+        self.shard_for(key)[key] = value
+
+    def __delitem__(self, key):
+        del self.shard_for(key)[key]
+
+    def items(self):
+        iterators = [((k.lower(), k, v) for k, v in shard.items())
+                     for shard in self._shards]
+        for _, key, value in heapq.merge(*iterators):
+            yield key, value
+
+    def keys(self):
+        for key, _ in self.items():
+            yield key
+
+    def keys_after(self, code=None):
+        iterators = [((k.lower(), k) for k in shard.keys_after(code))
+                     for shard in self._shards]
+        for _, key in heapq.merge(*iterators):
+            yield key
+
+    def values(self):
+        for _, value in self.items():
+            yield value
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return sum(len(x) for x in self._shards)
+
+
+def index_invitations(invitations, intids=None, catalog=None):
+    """
+    Register the given invitations with the intid utility and index
+    them in the invitations catalog, if there are such utilities.
+    """
+    intids = component.queryUtility(IIntIds) if intids is None else intids
+    if intids is None:
+        return
+    doc_ids = [intids.register(x) for x in invitations]
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    if catalog is not None:
+        for doc_id, invitation in zip(doc_ids, invitations):
+            catalog.index_doc(doc_id, invitation)
+
+
+def unindex_invitations(invitations, intids=None, catalog=None):
+    """
+    Unindex the given invitations from the invitations catalog and
+    unregister them from the intid utility, if there are such utilities.
+    """
+    intids = component.queryUtility(IIntIds) if intids is None else intids
+    if intids is None:
+        return
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    for invitation in invitations:
+        doc_id = intids.queryId(invitation)
+        if doc_id is None:
+            continue
+        if catalog is not None:
+            catalog.unindex_doc(doc_id)
+        intids.unregister(invitation)
+
+
+def pin_invitation_sites(container=None, site_name=None,
+                         batch_size=DEFAULT_BATCH_SIZE, commit=False):
+    """
+    Migration that stores the site of the invitations in the given container
+    that do not have one yet. ``site_name`` defaults to the name of the
+    current site, which is what reading the site of those invitations
+    returns.
+
+    Invitations are visited in code order, ``batch_size`` at a time. After
+    each batch the current transaction is committed if ``commit`` is true,
+    otherwise a savepoint is made, so that the visited invitations can be
+    released from memory.
+
+    :return: The number of changed invitations.
+    """
+    container = component.getUtility(IInvitationsContainer) \
+             if container is None else container
+    result = 0
+    last = None
+    while True:
+        batch = list(islice(container.keys_after(last), batch_size))
+        if not batch:
+            break
+        for code in batch:
+            invitation = container.get(code)
+            if invitation is not None and pin_site(invitation, site_name):
+                result += 1
+        last = batch[-1]
+        if commit:
+            transaction.commit()
+        else:
+            transaction.savepoint(optimistic=True)
+        jar = getattr(container, '_p_jar', None)
+        if jar is not None:
+            jar.cacheGC()
+    logger.info("Site pinned for %s invitation(s)", result)
+    return result
+
+
+def reindex_invitations(container=None,
+                        catalog=None,
+                        intids=None,
+                        indexes=None,
+                        batch_size=DEFAULT_BATCH_SIZE,
+                        checkpoint=None,
+                        time_budget=None,
+                        commit=True):
+    """
+    Rebuild the invitations catalog from the invitations in the given
+    container, ``batch_size`` invitations at a time, committing the
+    current transaction after each batch if ``commit`` is true.
+
+    Invitations are visited in code order. ``checkpoint`` is the last code
+    visited by a previous run; visiting resumes right after it. If
+    ``time_budget`` is given, the rebuild stops once that many seconds
+    have elapsed at the end of a batch.
+
+    Only the named ``indexes`` are rebuilt if given; otherwise every
+    index is. The missing indexes among them are added to the catalog
+    first, and queries do not use them until the rebuild completes.
+    Invitations without an intid are skipped.
+
+    :return: A tuple with the number of reindexed invitations and the
+        checkpoint to resume from, or ``None`` if the rebuild completed.
+    """
+    start = time.time()
+    container = component.getUtility(IInvitationsContainer) \
+             if container is None else container
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    added = add_missing_indexes(catalog, indexes, intids)
+    if added:
+        logger.info("Added index(es) %s", ', '.join(added))
+    names = indexes
+    if indexes is not None:
+        indexes = [catalog[name] for name in indexes]
+
+    count = 0
+    while True:
+        # scan from the checkpoint every batch, the container may change
+        # between commits. invitations added meanwhile are indexed when added
+        batch = list(islice(container.keys_after(checkpoint), batch_size))
+        if not batch:
+            break
+        for code in batch:
+            invitation = container.get(code)
+            doc_id = intids.queryId(invitation) if invitation is not None else None
+            if doc_id is None:
+                continue
+            if indexes is None:
+                catalog.index_doc(doc_id, invitation)
+            else:
+                for index in indexes:
+                    index.index_doc(doc_id, invitation)
+            count += 1
+        if indexes is not None:
+            catalog.bump_generation()
+        checkpoint = batch[-1]
+        if commit:
+            transaction.commit()
+        elapsed = time.time() - start
+        logger.info("%s invitation(s) reindexed in %.2f(s) (%.1f/s), at %s",
+                    count, elapsed, count / elapsed if elapsed else 0,
+                    checkpoint)
+        if time_budget is not None and elapsed >= time_budget:
+            return count, checkpoint
+    if isinstance(catalog, InvitationsCatalog):
+        catalog.mark_ready(names)
+        if commit:
+            transaction.commit()
+    return count, None
+
+
+def install_invitations_container(site_manager_container, intids=None,
+                                  factory=InvitationsContainer):
     lsm = site_manager_container.getSiteManager()
     intids = lsm.getUtility(IIntIds) if intids is None else intids
     registry = lsm.queryUtility(IInvitationsContainer)
     if registry is None:
-        registry = InvitationsContainer()
+        registry = factory()
         registry.__parent__ = site_manager_container
         registry.__name__ = u'++etc++invitations-container'
         intids.register(registry)
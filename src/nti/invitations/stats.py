@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from BTrees.Length import Length
+
+from BTrees.OOBTree import OOBTree
+
+from persistent import Persistent
+
+from zope import component
+from zope import interface
+
+from zope.container.contained import Contained
+
+from nti.invitations.interfaces import IInvitationsContainer
+from nti.invitations.interfaces import IActionableInvitation
+from nti.invitations.interfaces import IInvitationsStatistics
+
+#: All the invitations
+STATE_TOTAL = u'total'
+
+#: Sent invitations
+STATE_SENT = u'sent'
+
+#: Accepted invitations
+STATE_ACCEPTED = u'accepted'
+
+#: Invitations not accepted yet, whether expired or not
+STATE_UNACCEPTED = u'unaccepted'
+
+STATES = (STATE_TOTAL, STATE_SENT, STATE_ACCEPTED)
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def invitation_states(invitation):
+    """
+    Return the counted states of the given invitation.
+    """
+    result = [STATE_TOTAL]
+    if invitation.sent:
+        result.append(STATE_SENT)
+    if invitation.is_accepted():
+        result.append(STATE_ACCEPTED)
+    return result
+
+
+@interface.implementer(IInvitationsStatistics)
+class InvitationsStatistics(Persistent, Contained):
+    """
+    Keeps a conflict-free :class:`BTrees.Length.Length` counter for
+    every ``(site, sender, state)`` triple. An empty site or sender
+    stands for all of them.
+    """
+
+    def __init__(self):
+        self._counters = OOBTree()
+
+    @staticmethod
+    def _keys(site, sender, state):
+        site = site or u''
+        sender = sender or u''
+        result = [(u'', u'', state)]
+        if site:
+            result.append((site, u'', state))
+        if sender:
+            result.append((u'', sender, state))
+        if site and sender:
+            result.append((site, sender, state))
+        return result
+
+    def change(self, invitation, state, delta=1):
+        site = getattr(invitation, 'site', None)
+        sender = getattr(invitation, 'sender', None)
+        for key in self._keys(site, sender, state):
+            counter = self._counters.get(key)
+            if counter is None:
+                counter = self._counters[key] = Length()
+            counter.change(delta)
+
+    def count(self, state, site=None, sender=None):
+        if state == STATE_UNACCEPTED:
+            return self.count(STATE_TOTAL, site, sender) \
+                 - self.count(STATE_ACCEPTED, site, sender)
+        counter = self._counters.get((site or u'', sender or u'', state))
+        return counter() if counter is not None else 0
+
+    def counts(self, site=None, sender=None):
+        result = dict()
+        for state in STATES + (STATE_UNACCEPTED,):
+            result[state] = self.count(state, site, sender)
+        return result
+
+    def clear(self):
+        self._counters.clear()
+
+
+def get_invitations_statistics(registry=component):
+    return registry.queryUtility(IInvitationsStatistics)
+
+
+def record_invitations(invitations, delta=1, statistics=None):
+    """
+    Add (or subtract) the given invitations to the totals of the states
+    they are in.
+    """
+    statistics = get_invitations_statistics() if statistics is None else statistics
+    if statistics is None:
+        return
+    for invitation in invitations:
+        if IActionableInvitation.providedBy(invitation):
+            for state in invitation_states(invitation):
+                statistics.change(invitation, state, delta)
+
+
+def rebuild_invitations_statistics(container=None, statistics=None):
+    """
+    Reset the totals and count the invitations in the given container.
+    """
+    container = component.getUtility(IInvitationsContainer) \
+        if container is None else container
+    statistics = get_invitations_statistics() if statistics is None else statistics
+    statistics.clear()
+    record_invitations(container.values(), statistics=statistics)
+    return statistics
+
+
+def install_invitations_statistics(site_manager_container, container=None):
+    lsm = site_manager_container.getSiteManager()
+    statistics = lsm.queryUtility(IInvitationsStatistics)
+    if statistics is None:
+        statistics = InvitationsStatistics()
+        statistics.__parent__ = site_manager_container
+        statistics.__name__ = u'++etc++invitations-statistics'
+        lsm.registerUtility(statistics, provided=IInvitationsStatistics)
+        container = lsm.queryUtility(IInvitationsContainer) \
+            if container is None else container
+        if container is not None:
+            rebuild_invitations_statistics(container, statistics)
+    return statistics
@@ -12,12 +12,83 @@ import time
 
 from zope import component
 
+from zope.intid.interfaces import IIntIds
+
+from zope.lifecycleevent.interfaces import IObjectAddedEvent
+from zope.lifecycleevent.interfaces import IObjectRemovedEvent
+
+from nti.invitations.index import IX_SENTTIME
+
+from nti.invitations.index import get_invitations_catalog
+
 from nti.invitations.interfaces import IInvitationSentEvent
+from nti.invitations.interfaces import IInvitationsContainer
 from nti.invitations.interfaces import IActionableInvitation
+from nti.invitations.interfaces import IInvitationsAddedEvent
+from nti.invitations.interfaces import IInvitationsRemovedEvent
+from nti.invitations.interfaces import IInvitationAcceptedEvent
+
+from nti.invitations.stats import STATE_SENT
+from nti.invitations.stats import STATE_ACCEPTED
+
+from nti.invitations.stats import record_invitations
+from nti.invitations.stats import get_invitations_statistics
 
 logger = __import__('logging').getLogger(__name__)
 
 
 @component.adapter(IActionableInvitation, IInvitationSentEvent)
 def _on_invitation_sent(invitation, unused_event):
+    first_time = not invitation.sent
     invitation.sent = time.time()
+    if first_time:
+        _change_statistics(invitation, STATE_SENT)
+    # only the sent time index needs updating
+    intids = component.queryUtility(IIntIds)
+    catalog = get_invitations_catalog()
+    if intids is None or catalog is None or IX_SENTTIME not in catalog:
+        return
+    doc_id = intids.queryId(invitation)
+    if doc_id is not None:
+        catalog[IX_SENTTIME].index_doc(doc_id, invitation)
+        catalog.bump_generation()
+
+
+def _is_registered(invitation):
+    return IInvitationsContainer.providedBy(getattr(invitation, '__parent__', None))
+
+
+def _change_statistics(invitation, state, delta=1):
+    # only the invitations in a container are counted
+    statistics = get_invitations_statistics()
+    if statistics is not None and _is_registered(invitation):
+        statistics.change(invitation, state, delta)
+
+
+@component.adapter(IActionableInvitation, IInvitationAcceptedEvent)
+def _on_invitation_accepted(invitation, event):
+    # accepting again does not change the totals
+    if not getattr(event, 'was_accepted', False):
+        _change_statistics(invitation, STATE_ACCEPTED)
+
+
+@component.adapter(IActionableInvitation, IObjectAddedEvent)
+def _on_invitation_added(invitation, event):
+    if IInvitationsContainer.providedBy(event.newParent):
+        record_invitations((invitation,))
+
+
+@component.adapter(IActionableInvitation, IObjectRemovedEvent)
+def _on_invitation_removed(invitation, event):
+    if IInvitationsContainer.providedBy(event.oldParent):
+        record_invitations((invitation,), -1)
+
+
+@component.adapter(IInvitationsContainer, IInvitationsAddedEvent)
+def _on_invitations_added(unused_container, event):
+    record_invitations(event.invitations)
+
+
+@component.adapter(IInvitationsContainer, IInvitationsRemovedEvent)
+def _on_invitations_removed(unused_container, event):
+    record_invitations(event.invitations, -1)
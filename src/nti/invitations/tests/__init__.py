@@ -13,6 +13,13 @@ from nti.testing.layers import ConfiguringLayerMixin
 
 import zope.testing.cleanup
 
+from nti.invitations.utils import clear_site_names_cache
+
+from nti.invitations.wref import clear_invitations_container_cache
+
+zope.testing.cleanup.addCleanUp(clear_site_names_cache)
+zope.testing.cleanup.addCleanUp(clear_invitations_container_cache)
+
 
 class SharedConfiguringTestLayer(ZopeComponentLayer,
                                  GCLayerMixin,
@@ -35,7 +42,8 @@ class SharedConfiguringTestLayer(ZopeComponentLayer,
 
     @classmethod
     def testTearDown(cls):
-        pass
+        clear_site_names_cache()
+        clear_invitations_container_cache()
 
 
 import unittest
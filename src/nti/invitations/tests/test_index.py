@@ -13,6 +13,7 @@ from hamcrest import is_not
 from hamcrest import has_length
 from hamcrest import assert_that
 
+import time
 import pickle
 import unittest
 
@@ -24,14 +25,24 @@ from zope import component
 
 from zope.catalog.interfaces import ICatalog
 
+from zope.intid.interfaces import IIntIds
+
 from nti.invitations.index import CATALOG_NAME
+from nti.invitations.index import NEVER_EXPIRES
+from nti.invitations.index import IX_EFFECTIVE_EXPIRYTIME
 
 from nti.invitations.index import ValidatingSite
+from nti.invitations.index import InvitationsCatalog
+from nti.invitations.index import InvitationsQueryCache
 from nti.invitations.index import ValidatingAccepted
 from nti.invitations.index import ValidatingMimeType
+from nti.invitations.index import ValidatingEffectiveExpiryTime
+from nti.invitations.index import filter_doc_ids
 from nti.invitations.index import create_invitations_catalog
 from nti.invitations.index import install_invitations_catalog
 
+from nti.invitations.interfaces import IInvitationsQueryCache
+
 from nti.invitations.model import Invitation
 
 
@@ -40,7 +51,8 @@ class TestIndex(unittest.TestCase):
     def test_pickle(self):
         for factory in (ValidatingAccepted,
                         ValidatingMimeType,
-                        ValidatingSite):
+                        ValidatingSite,
+                        ValidatingEffectiveExpiryTime):
             with self.assertRaises(TypeError):
                 pickle.dumps(factory())
 
@@ -61,6 +73,234 @@ class TestIndex(unittest.TestCase):
         assert_that(ids, is_not(none()))
         assert_that(ids, has_length(1))
 
+    def test_effective_expiry_time(self):
+        invitation = Invitation(code=u'bleach',
+                                receiver=u'ichigo',
+                                sender=u'aizen')
+        catalog = create_invitations_catalog(family=BTrees.family64)
+        catalog.index_doc(1, invitation)
+        invitation.expiryTime = 100
+        catalog.index_doc(2, invitation)
+        ids = catalog.apply({
+            IX_EFFECTIVE_EXPIRYTIME: {'between': (NEVER_EXPIRES, NEVER_EXPIRES)}
+        })
+        assert_that(list(ids), is_([1]))
+        ids = catalog.apply({
+            IX_EFFECTIVE_EXPIRYTIME: {'between': (60, NEVER_EXPIRES)}
+        })
+        assert_that(list(ids), is_([1, 2]))
+
+    def test_query_cache(self):
+        cache = InvitationsQueryCache()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(cache, IInvitationsQueryCache)
+        try:
+            invitation = Invitation(code=u'bleach',
+                                    receiver=u'ichigo',
+                                    sender=u'aizen')
+            catalog = create_invitations_catalog(family=BTrees.family64)
+            catalog.index_doc(1, invitation)
+            generation = catalog.generation
+            query = {
+                'sender': {'any_of': set(('aizen', 'AIZEN'))},
+                'expiryTime': {'between': (60, time.time())},
+            }
+            assert_that(list(catalog.apply(query)), is_([]))
+            query['expiryTime'] = {'any_of': (0,)}
+            assert_that(list(catalog.apply(query)), is_([1]))
+            assert_that(cache, has_length(2))
+            # cached
+            result = catalog.apply(query)
+            result.clear()
+            assert_that(list(catalog.apply(query)), is_([1]))
+            assert_that(cache, has_length(2))
+            # invalidated
+            catalog.index_doc(2, invitation)
+            assert_that(catalog.generation, is_(generation + 1))
+            assert_that(list(catalog.apply(query)), is_([1, 2]))
+            assert_that(cache, has_length(3))
+            catalog.unindex_doc(2)
+            assert_that(list(catalog.apply(query)), is_([1]))
+        finally:
+            gsm.unregisterUtility(cache, IInvitationsQueryCache)
+
+    def test_query_cache_ranges(self):
+        cache = InvitationsQueryCache()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(cache, IInvitationsQueryCache)
+        try:
+            now = time.time()
+            catalog = create_invitations_catalog(family=BTrees.family64)
+            for uid, expiry in ((1, now - 100), (2, now + 100)):
+                catalog.index_doc(uid, Invitation(code=u'code%s' % uid,
+                                                  receiver=u'ichigo',
+                                                  expiryTime=expiry))
+            # pending queries at different times share the cache entry
+            for delta, expected in ((0, [2]), (1, [2]), (-200, [1, 2])):
+                query = {
+                    'receiver': {'any_of': ('ichigo',)},
+                    'expiryTime': {'between': (now + delta, NEVER_EXPIRES)},
+                }
+                result = catalog.apply(query)
+                assert_that(list(result), is_(expected))
+                # the cached entry is not changed through the result
+                result.clear()
+            assert_that(cache, has_length(1))
+            # range only queries are not cached
+            query = {'expiryTime': {'between': (60, now)}}
+            assert_that(list(catalog.apply(query)), is_([1]))
+            assert_that(cache, has_length(1))
+        finally:
+            gsm.unregisterUtility(cache, IInvitationsQueryCache)
+
+    def test_generation(self):
+        invitation = Invitation(code=u'bleach', receiver=u'ichigo')
+
+        class MockInt(object):
+            def __iter__(self):
+                return iter([1])
+
+            def getObject(self, unused_uid):
+                return invitation
+
+        intids = MockInt()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            catalog = create_invitations_catalog(family=BTrees.family64)
+            generation = catalog.generation
+            catalog.mark_building('receiver')
+            catalog.mark_building('sender')
+            catalog.updateIndex(catalog['receiver'])
+            assert_that(catalog.generation, is_(generation + 1))
+            # a filled index is ready
+            assert_that(catalog.is_ready('receiver'), is_(True))
+            assert_that(catalog.is_ready('sender'), is_(False))
+            catalog.updateIndexes(ignore_persistence_exceptions=True)
+            assert_that(catalog.generation, is_(generation + 2))
+            assert_that(catalog.is_ready('sender'), is_(True))
+            assert_that(list(catalog.apply({'receiver': {'any_of': ('ichigo',)}})),
+                        is_([1]))
+            catalog.clear()
+            assert_that(catalog.generation, is_(generation + 3))
+            # old catalogs without a generation
+            catalog._generation = None
+            assert_that(catalog.generation, is_(none()))
+            catalog.bump_generation()
+            assert_that(catalog.generation, is_(1))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+
+    def test_planner(self):
+        catalog = create_invitations_catalog(family=BTrees.family64)
+        for i in range(1, 41):
+            invitation = Invitation(code=u'code%s' % i,
+                                    receiver=u'user%s' % (i % 10),
+                                    sender=u'aizen' if i % 2 else u'ichigo',
+                                    site=u'site%s' % (i % 3),
+                                    acceptedTime=90 if i % 4 == 0 else None,
+                                    expiryTime=0 if i % 5 else 100)
+            catalog.index_doc(i, invitation)
+
+        query = {
+            'site': {'any_of': ('site0', 'site1')},
+            'accepted': {'any_of': (False,)},
+            'receiver': {'any_of': ('USER3',)},
+        }
+        plan = catalog.plan(query)
+        assert_that([x[1] for x in plan], is_(['receiver', 'site', 'accepted']))
+        assert_that(plan[0][0], is_(4))
+
+        queries = (query,
+                   {'receiver': {'any_of': ('user3', 'user4')},
+                    'sender': {'any_of': ('aizen',)},
+                    'expiryTime': {'between': (60, 200)}},
+                   {'receiver': {'any_of': ('nobody',)},
+                    'site': {'any_of': ('site1',)}},
+                   {'site': {'any_of': ('site2',)},
+                    'mimeType': {'any_of': (Invitation.mimeType,)}},
+                   {'sender': {'any_of': ('ichigo',)},
+                    'accepted': {'any_of': (True,)}})
+        for q in queries:
+            expected = super(InvitationsCatalog, catalog).apply(q)
+            assert_that(list(catalog.apply(q)), is_(list(expected)))
+
+        # broad postings are only counted up to the limit
+        catalog.estimate_limit = 5
+        assert_that(catalog.plan(query),
+                    is_([(4, 'receiver'), (6, 'accepted'), (6, 'site')]))
+        # raised while every estimate exceeds it
+        del query['receiver']
+        assert_that(catalog.plan(query),
+                    is_([(27, 'site'), (30, 'accepted')]))
+        for q in queries:
+            expected = super(InvitationsCatalog, catalog).apply(q)
+            assert_that(list(catalog.apply(q)), is_(list(expected)))
+
+    def test_normalized_any_of(self):
+        catalog = create_invitations_catalog(family=BTrees.family64)
+        for i, receiver in enumerate((u'ichigo', u'Ichigo', u'rukia'), 1):
+            catalog.index_doc(i, Invitation(code=u'code%s' % i,
+                                            receiver=receiver,
+                                            site=u'dataserver2'))
+        query = {'receiver': {'any_of': ('ICHIGO', 'nobody')}}
+        assert_that(catalog.estimate('receiver', query['receiver']), is_(2))
+        assert_that(catalog.estimate('receiver', query['receiver'], 1), is_(2))
+        assert_that(list(catalog.apply(query)), is_([1, 2]))
+        query['site'] = {'any_of': ('dataserver2',)}
+        assert_that(list(catalog.apply(query)), is_([1, 2]))
+        assert_that(list(filter_doc_ids(catalog['receiver'],
+                                        {'any_of': ('RUKIA',)},
+                                        [1, 2, 3])),
+                    is_([3]))
+
+    def test_explain(self):
+        catalog = create_invitations_catalog(family=BTrees.family64)
+        for i in range(1, 41):
+            invitation = Invitation(code=u'code%s' % i,
+                                    receiver=u'user%s' % (i % 10),
+                                    site=u'site%s' % (i % 3),
+                                    acceptedTime=90 if i % 4 == 0 else None)
+            catalog.index_doc(i, invitation)
+
+        query = {
+            'site': {'any_of': ('site0', 'site1')},
+            'accepted': {'any_of': (False,)},
+            'receiver': {'any_of': ('USER3',)},
+        }
+        report = catalog.explain(query)
+        assert_that(report['query']['receiver'], is_({'any_of': ['user3']}))
+        assert_that([x[1] for x in report['plan']],
+                    is_(['receiver', 'site', 'accepted']))
+        steps = report['steps']
+        assert_that([(x['index'], x['strategy'], x['size']) for x in steps],
+                    is_([('receiver', 'apply', 4),
+                         ('site', 'filter', 3),
+                         ('accepted', 'filter', 3)]))
+        assert_that(report['result_size'], is_(len(catalog.apply(query))))
+
+        # evaluation stops at the first empty result
+        query['receiver'] = {'any_of': ('nobody',)}
+        report = catalog.explain(query)
+        assert_that(report['steps'], has_length(1))
+        assert_that(report['result_size'], is_(0))
+
+    def test_query_cache_bounds(self):
+        cache = InvitationsQueryCache(max_entries=2, max_ids=3)
+        cache.set('a', [1])
+        cache.set('b', [2])
+        assert_that(cache.get('a'), is_([1]))
+        cache.set('c', [3])
+        # least recently used
+        assert_that(cache.get('b'), is_(none()))
+        cache.set('d', [4, 5])
+        assert_that(cache, has_length(2))
+        assert_that(cache.get('a'), is_(none()))
+        cache.set('e', [1, 2, 3, 4])
+        assert_that(cache.get('e'), is_(none()))
+        cache.clear()
+        assert_that(cache, has_length(0))
+
     def test_install_publishing_catalog(self):
         intids = fudge.Fake().provides('register').has_attr(family=BTrees.family64)
         catalog = install_invitations_catalog(component, intids)
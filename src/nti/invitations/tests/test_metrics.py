@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import has_item
+from hamcrest import has_entry
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import instance_of
+
+import time
+
+import fudge
+
+import BTrees
+
+from zope import component
+from zope import interface
+
+from zope.intid.interfaces import IIntIds
+
+from nti.invitations.index import create_invitations_catalog
+
+from nti.invitations.interfaces import IInvitationsMetrics
+from nti.invitations.interfaces import IInvitationsContainer
+
+from nti.invitations.metrics import NULL_METRICS
+from nti.invitations.metrics import METRIC_ACCEPT
+from nti.invitations.metrics import METRIC_ACCEPTED
+from nti.invitations.metrics import METRIC_OBJECTS_FILTERED
+
+from nti.invitations.metrics import NullInvitationsMetrics
+
+from nti.invitations.metrics import get_invitations_metrics
+
+from nti.invitations.model import UserInvitation
+from nti.invitations.model import InvitationsContainer
+
+from nti.invitations.model import install_invitations_container
+
+from nti.invitations.utils import accept_invitation
+from nti.invitations.utils import get_invitation_intids
+from nti.invitations.utils import get_sent_invitation_ids
+from nti.invitations.utils import get_pending_invitations
+from nti.invitations.utils import sweep_expired_invitations
+from nti.invitations.utils import delete_expired_invitations
+
+from nti.invitations.tests import InvitationLayerTest
+
+
+@interface.implementer(IInvitationsMetrics)
+class RecordingMetrics(object):
+
+    def __init__(self):
+        self.counters = dict()
+        self.timings = []
+        self.observed = []
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, seconds):
+        self.timings.append(name)
+
+    def observe(self, name, value):
+        self.observed.append((name, value))
+
+
+class TestMetrics(InvitationLayerTest):
+
+    def setUp(self):
+        self.metrics = RecordingMetrics()
+        component.getGlobalSiteManager().registerUtility(self.metrics,
+                                                         IInvitationsMetrics)
+
+    def tearDown(self):
+        component.getGlobalSiteManager().registerUtility(NULL_METRICS,
+                                                         IInvitationsMetrics)
+
+    def test_default(self):
+        self.tearDown()
+        assert_that(get_invitations_metrics(), instance_of(NullInvitationsMetrics))
+
+    def test_queries(self):
+        catalog = create_invitations_catalog(family=BTrees.family64)
+        invitations = [UserInvitation(code=u'bleach', receiver=u'ichigo',
+                                      sender=u'aizen', site=u'dataserver2',
+                                      expiryTime=time.time() + 1000),
+                       UserInvitation(code=u'kido', receiver=u'rukia',
+                                      sender=u'aizen', site=u'dataserver2')]
+        for uid, invitation in enumerate(invitations, 1):
+            catalog.index_doc(uid, invitation)
+
+        assert_that(get_invitation_intids(catalog=catalog), has_length(2))
+        assert_that(self.metrics.timings, is_(['invitations.query.pending']))
+        assert_that(self.metrics.observed,
+                    is_([('invitations.query.pending.size', 2)]))
+
+        class MockInt(object):
+            def queryObject(self, uid):
+                # the second one is gone
+                return invitations[0] if uid == 1 else None
+
+        intids = MockInt()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            assert_that(get_pending_invitations(catalog=catalog),
+                        is_([invitations[0]]))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+        assert_that(self.metrics.counters,
+                    has_entry(METRIC_OBJECTS_FILTERED, 1))
+
+    def test_container(self):
+        container = InvitationsContainer()
+        container.add(UserInvitation(code=u'bleach', receiver=u'ichigo'))
+        container.add_many([UserInvitation(code=u'kido', receiver=u'rukia'),
+                            UserInvitation(code=u'bankai', receiver=u'renji')])
+        container.remove(u'bleach')
+        container.remove(u'missing')
+        assert_that(self.metrics.counters,
+                    has_entry('invitations.container.added', 3))
+        assert_that(self.metrics.counters,
+                    has_entry('invitations.container.removed', 1))
+        assert_that(self.metrics.timings,
+                    has_item('invitations.container.add_many'))
+
+    def test_sent(self):
+        catalog = create_invitations_catalog(family=BTrees.family64)
+        catalog.index_doc(1, UserInvitation(code=u'bleach', receiver=u'ichigo',
+                                            sender=u'aizen'))
+        assert_that(get_sent_invitation_ids(u'aizen', catalog=catalog),
+                    has_length(1))
+        assert_that(self.metrics.timings, is_(['invitations.query.sent']))
+        assert_that(self.metrics.observed,
+                    is_([('invitations.query.sent.size', 1)]))
+
+    @fudge.patch("nti.invitations.utils.get_invitation_actor")
+    def test_accept(self, mock_ga):
+        fake_actor = fudge.Fake()
+        fake_actor.provides("accept").returns(True)
+        mock_ga.is_callable().returns(fake_actor)
+        invitation = UserInvitation(code=u'bleach', receiver=u'ichigo')
+        assert_that(accept_invitation(u'ichigo', invitation), is_(True))
+        assert_that(self.metrics.timings, is_([METRIC_ACCEPT]))
+        assert_that(self.metrics.counters, has_entry(METRIC_ACCEPTED, 1))
+
+    def test_expired(self):
+        now = time.time()
+        catalog = create_invitations_catalog(family=BTrees.family64)
+        invitations = [UserInvitation(code=u'bleach', receiver=u'ichigo',
+                                      expiryTime=now - 1000),
+                       UserInvitation(code=u'kido', receiver=u'rukia',
+                                      expiryTime=now - 1000),
+                       UserInvitation(code=u'bankai', receiver=u'renji')]
+        for uid, invitation in enumerate(invitations, 1):
+            catalog.index_doc(uid, invitation)
+
+        class MockInt(object):
+            def queryObject(self, uid):
+                return invitations[uid - 1]
+
+            def register(self, obj):
+                pass
+
+        intids = MockInt()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        container = install_invitations_container(component, intids)
+        try:
+            for invitation in invitations:
+                container.add(invitation)
+            delete_expired_invitations(receivers=u'ichigo', now=now,
+                                       catalog=catalog)
+            assert_that(self.metrics.timings,
+                        has_item('invitations.expired.delete'))
+            assert_that(self.metrics.counters,
+                        has_entry('invitations.expired.removed', 1))
+
+            sweep_expired_invitations(now=now, catalog=catalog, commit=False)
+            assert_that(self.metrics.timings,
+                        has_item('invitations.expired.sweep'))
+            assert_that(self.metrics.counters,
+                        has_entry('invitations.expired.removed', 2))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+            gsm.unregisterUtility(container, IInvitationsContainer)
@@ -11,6 +11,7 @@ from hamcrest import is_
 from hamcrest import none
 from hamcrest import all_of
 from hamcrest import is_not
+from hamcrest import has_key
 from hamcrest import has_entry
 from hamcrest import has_length
 from hamcrest import assert_that
@@ -19,20 +20,57 @@ from hamcrest import has_property
 from nti.testing.matchers import validly_provides
 from nti.testing.matchers import verifiably_provides
 
+import os
+import shutil
+import tempfile
+
+import BTrees
+
 import fudge
 
+import transaction
+
+from ZODB.DB import DB
+
+from ZODB.FileStorage import FileStorage
+
+from ZODB.MappingStorage import MappingStorage
+
+from ZODB.POSException import ConflictError
+
 from zope import component
 
+from zope.catalog.interfaces import ICatalog
+
+from zope.intid.interfaces import IIntIds
+
 from nti.externalization.tests import externalizes
 
+from nti.invitations.index import IX_SITE
+from nti.invitations.index import IX_RECEIVER
+from nti.invitations.index import CATALOG_NAME
+from nti.invitations.index import IX_EXPIRYTIME
+
+from nti.invitations.index import index_ready
+from nti.invitations.index import create_invitations_catalog
+
 from nti.invitations.interfaces import IUserInvitation
+from nti.invitations.interfaces import IInvitationsAddedEvent
+from nti.invitations.interfaces import IInvitationCodeAllocator
+from nti.invitations.interfaces import IInvitationsRemovedEvent
 from nti.invitations.interfaces import IInvitationsContainer
 from nti.invitations.interfaces import DuplicateInvitationCodeError
 
 from nti.invitations.model import UserInvitation
 from nti.invitations.model import InvitationsContainer
+from nti.invitations.model import ShardedInvitationsContainer
+from nti.invitations.model import reindex_invitations
+from nti.invitations.model import pin_invitation_sites
 from nti.invitations.model import install_invitations_container
 
+from nti.invitations.utils import InvitationCodePrefixes
+from nti.invitations.utils import PrefixedInvitationCodeAllocator
+
 from nti.invitations.tests import InvitationLayerTest
 
 
@@ -68,6 +106,125 @@ class TestModel(InvitationLayerTest):
 
         assert_that(invitation, validly_provides(IUserInvitation))
 
+    @fudge.patch('nti.invitations.model.getSite')
+    def test_site_pinned_on_add(self, mock_gs):
+        fake_site = fudge.Fake().has_attr(__name__=u'anime')
+        mock_gs.is_callable().returns(fake_site)
+
+        invitation = UserInvitation(code=u'bleach', receiver=u'ichigo')
+        assert_that(invitation.site, is_(u'anime'))
+        # reading does not write
+        assert_that(invitation.__dict__, is_not(has_key('site')))
+
+        container = InvitationsContainer()
+        container.add(invitation)
+        assert_that(invitation.__dict__, has_entry('site', u'anime'))
+
+        other = UserInvitation(code=u'kido', receiver=u'rukia', site=u'manga')
+        container.add_many([other])
+        assert_that(other.site, is_(u'manga'))
+
+        # the container API
+        for target in (container, ShardedInvitationsContainer(shards=2)):
+            item = UserInvitation(code=u'bankai', receiver=u'renji')
+            target[u'bankai'] = item
+            assert_that(item.__dict__, has_entry('site', u'anime'))
+
+        # migration
+        legacy = UserInvitation(code=u'legacy', receiver=u'renji')
+        container._setitemf(u'legacy', legacy)
+        assert_that(pin_invitation_sites(container), is_(1))
+        assert_that(legacy.__dict__, has_entry('site', u'anime'))
+        assert_that(pin_invitation_sites(container, u'manga'), is_(0))
+
+        # in batches
+        sharded = ShardedInvitationsContainer(shards=2)
+        for code in (u'aaaa', u'bbbb', u'cccc'):
+            item = UserInvitation(code=code, receiver=u'renji')
+            sharded.add(item)
+            del item.__dict__['site']
+        assert_that(pin_invitation_sites(sharded, u'manga', batch_size=2),
+                    is_(3))
+        assert_that(sharded.get(u'bbbb').__dict__, has_entry('site', u'manga'))
+
+    def test_resolve_conflict(self):
+        invitation = UserInvitation()
+        old = {'code': u'bleach', 'receiver': u'ichigo@bleach.org',
+               'sent': None}
+        # sent and accepted concurrently
+        saved = dict(old, sent=20)
+        new = dict(old, acceptedTime=30, receiver=u'ichigo')
+        assert_that(invitation._p_resolveConflict(old, saved, new),
+                    is_({'code': u'bleach', 'receiver': u'ichigo', 'sent': 20,
+                         'acceptedTime': 30}))
+        # both sent
+        saved = dict(old, sent=20)
+        new = dict(old, sent=15)
+        assert_that(invitation._p_resolveConflict(old, saved, new),
+                    has_entry('sent', 20))
+        # attribute removed on one side
+        saved = dict(old)
+        new = dict(old)
+        del new['sent']
+        assert_that(invitation._p_resolveConflict(old, saved, new),
+                    is_not(has_key('sent')))
+        # same attribute with different values
+        saved = dict(old, receiver=u'aizen')
+        new = dict(old, receiver=u'ichigo')
+        with self.assertRaises(ConflictError):
+            invitation._p_resolveConflict(old, saved, new)
+        with self.assertRaises(ConflictError):
+            invitation._p_resolveConflict(old, (saved, None), new)
+        # only numbers are merged
+        saved = dict(old, sent=u'20')
+        new = dict(old, sent=u'15')
+        with self.assertRaises(ConflictError):
+            invitation._p_resolveConflict(old, saved, new)
+
+    def test_resolve_conflict_storage(self):
+        tmpdir = tempfile.mkdtemp()
+        db = DB(FileStorage(os.path.join(tmpdir, 'Data.fs')))
+        try:
+            tm1 = transaction.TransactionManager()
+            conn1 = db.open(transaction_manager=tm1)
+            invitation = UserInvitation(code=u'bleach',
+                                        receiver=u'ichigo@bleach.org',
+                                        sender=u'aizen')
+            invitation.updateLastMod(10)
+            conn1.root()['invitation'] = invitation
+            tm1.commit()
+            assert_that(invitation.__getstate__(),
+                        all_of(has_key('code'), is_not(has_key('lastModified'))))
+
+            tm2 = transaction.TransactionManager()
+            conn2 = db.open(transaction_manager=tm2)
+            other = conn2.root()['invitation']
+            # load the state before the first change is committed
+            assert_that(other.lastModified, is_(10))
+
+            invitation.sent = 20
+            invitation.updateLastMod(20)
+            tm1.commit()
+
+            other.acceptedTime = 30
+            other.receiver = u'ichigo'
+            other.updateLastMod(30)
+            tm2.commit()
+
+            tm3 = transaction.TransactionManager()
+            conn3 = db.open(transaction_manager=tm3)
+            result = conn3.root()['invitation']
+            assert_that(result, has_property('sent', 20))
+            assert_that(result, has_property('acceptedTime', 30))
+            assert_that(result, has_property('receiver', u'ichigo'))
+            assert_that(result, has_property('lastModified', 30))
+            for tm, conn in ((tm1, conn1), (tm2, conn2), (tm3, conn3)):
+                tm.abort()
+                conn.close()
+        finally:
+            db.close()
+            shutil.rmtree(tmpdir)
+
     def test_misc(self):
         fragor = UserInvitation(code='fragor',
                                 receiver='ichigo',
@@ -110,6 +267,113 @@ class TestModel(InvitationLayerTest):
         container.remove(invitation)
         assert_that(container, has_length(is_(0)))
 
+    def test_add_many(self):
+        container = InvitationsContainer()
+        container.add(UserInvitation(code=u'bleach',
+                                     receiver=u'ichigo',
+                                     sender=u'aizen'))
+        invitations = [UserInvitation(receiver=u'rukia', sender=u'aizen'),
+                       UserInvitation(code=u'zangetsu', receiver=u'renji'),
+                       UserInvitation(receiver=u'orihime', sender=u'aizen')]
+        added = container.add_many(invitations)
+        assert_that(added, has_length(3))
+        assert_that(container, has_length(4))
+        codes = [x.code for x in added]
+        assert_that(codes, is_(sorted(codes, key=lambda x: x.lower())))
+        for invitation in invitations:
+            assert_that(container.get_invitation_by_code(invitation.code),
+                        is_(invitation))
+
+        # Duplicates, nothing is added
+        duplicates = [UserInvitation(receiver=u'ichigo'),
+                      UserInvitation(code=u'BLEACH', receiver=u'ichigo')]
+        with self.assertRaises(DuplicateInvitationCodeError):
+            container.add_many(duplicates)
+        duplicates = [UserInvitation(code=u'kido', receiver=u'ichigo'),
+                      UserInvitation(code=u'Kido', receiver=u'ichigo')]
+        with self.assertRaises(DuplicateInvitationCodeError):
+            container.add_many(duplicates)
+        assert_that(container, has_length(4))
+
+    def test_add_many_no_events(self):
+        registered = []
+
+        class MockInt(object):
+            def register(self, obj):
+                registered.append(obj)
+                return len(registered)
+
+        events = []
+
+        def handler(event):
+            events.append(event)
+
+        intids = MockInt()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        gsm.registerHandler(handler, (IInvitationsAddedEvent,))
+
+        container = InvitationsContainer()
+        invitations = [UserInvitation(receiver=u'rukia', sender=u'aizen'),
+                       UserInvitation(receiver=u'orihime', sender=u'aizen')]
+        container.add_many(invitations, event=False)
+        assert_that(container, has_length(2))
+        assert_that(registered, has_length(2))
+        assert_that(events, has_length(1))
+        assert_that(events[0].invitations, has_length(2))
+        assert_that(invitations[0], has_property('__parent__', is_(container)))
+
+        gsm.unregisterHandler(handler, (IInvitationsAddedEvent,))
+        gsm.unregisterUtility(intids, IIntIds)
+
+    def test_remove_many(self):
+        unregistered = []
+
+        class MockInt(object):
+            def queryId(self, obj):
+                return 1 if obj.code != u'kido' else None
+
+            def unregister(self, obj):
+                unregistered.append(obj)
+
+        catalog = fudge.Fake().provides('unindex_doc')
+        events = []
+
+        def handler(event):
+            events.append(event)
+
+        intids = MockInt()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        gsm.registerUtility(catalog, ICatalog, CATALOG_NAME)
+        gsm.registerHandler(handler, (IInvitationsRemovedEvent,))
+
+        container = InvitationsContainer()
+        invitations = [UserInvitation(code=u'bleach', receiver=u'ichigo'),
+                       UserInvitation(code=u'zangetsu', receiver=u'ichigo'),
+                       UserInvitation(code=u'kido', receiver=u'rukia')]
+        for invitation in invitations:
+            container.add(invitation)
+
+        removed = container.remove_many([invitations[0], u'ZANGETSU', u'kido',
+                                         u'bleach', u'missing'])
+        # removed in code order
+        assert_that(removed, is_([invitations[0], invitations[2], invitations[1]]))
+        assert_that(container, has_length(0))
+        # no longer contained
+        for invitation in invitations:
+            assert_that(invitation, has_property('__parent__', none()))
+            assert_that(invitation, has_property('__name__', none()))
+        assert_that(unregistered, is_(invitations[:2]))
+        assert_that(events, has_length(1))
+
+        assert_that(container.remove_many([u'bleach']), is_([]))
+        assert_that(events, has_length(1))
+
+        gsm.unregisterHandler(handler, (IInvitationsRemovedEvent,))
+        gsm.unregisterUtility(catalog, ICatalog, CATALOG_NAME)
+        gsm.unregisterUtility(intids, IIntIds)
+
     @fudge.patch('nti.invitations.model.get_random_invitation_code')
     def test_random_code(self, mock_rc):
         invitation = UserInvitation(code=u'bleach',
@@ -128,6 +392,105 @@ class TestModel(InvitationLayerTest):
 
         assert_that(container.remove('enemy', False), is_(True))
 
+    @fudge.patch('nti.invitations.model.get_random_invitation_code')
+    def test_code_allocator(self, mock_rc):
+        mock_rc.is_callable().raises(AssertionError("Should not be called"))
+        allocator = PrefixedInvitationCodeAllocator(InvitationCodePrefixes())
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(allocator, IInvitationCodeAllocator)
+        try:
+            codes = set()
+            for container in (InvitationsContainer(),
+                              ShardedInvitationsContainer(shards=2)):
+                invitation = UserInvitation(receiver=u'ichigo')
+                container.add(invitation)
+                added = container.add_many([UserInvitation(receiver=u'rukia'),
+                                            UserInvitation(receiver=u'renji')])
+                assert_that(container, has_length(3))
+                assert_that(container[invitation.code], is_(invitation))
+                codes.update(x.code for x in added + [invitation])
+            assert_that(codes, has_length(6))
+        finally:
+            gsm.unregisterUtility(allocator, IInvitationCodeAllocator)
+
+    def test_code_prefixes_storage(self):
+        db = DB(MappingStorage())
+        try:
+            conn = db.open()
+            conn.root()['prefixes'] = InvitationCodePrefixes()
+            transaction.commit()
+            prefixes = conn.root()['prefixes']
+            first = PrefixedInvitationCodeAllocator(prefixes)
+            second = PrefixedInvitationCodeAllocator(prefixes)
+            codes = [first.allocate(), second.allocate(), first.allocate()]
+            assert_that([x[:7] for x in codes],
+                        is_(['0000-01', '0000-02', '0000-01']))
+            # the reservations outlive the transaction needing the codes
+            transaction.abort()
+            assert_that(prefixes.last, is_(2))
+            conn.close()
+        finally:
+            db.close()
+
+    def test_sharded_container(self):
+        container = ShardedInvitationsContainer(shards=4)
+        assert_that(container, verifiably_provides(IInvitationsContainer))
+        codes = [u'code%02d' % x for x in range(20)]
+        for code in codes[:10]:
+            container.add(UserInvitation(code=code, receiver=u'ichigo'))
+        added = container.add_many([UserInvitation(code=code, receiver=u'rukia')
+                                    for code in codes[10:]] +
+                                   [UserInvitation(receiver=u'renji')])
+        assert_that(added, has_length(11))
+        assert_that(container, has_length(21))
+        # spread over the shards
+        assert_that([len(x) for x in container.shards],
+                    is_not([21, 0, 0, 0]))
+        assert_that(sum(len(x) for x in container.shards), is_(21))
+
+        keys = list(container.keys())
+        assert_that(keys, is_(sorted(keys, key=lambda x: x.lower())))
+        assert_that(list(container), is_(keys))
+        assert_that([x.code for x in container.values()], is_(keys))
+        # the allocated code may sort anywhere
+        assert_that(list(container.keys_after(u'CODE09')),
+                    is_([x for x in keys if x.lower() > u'code09']))
+        assert_that(list(container.keys_after()), is_(keys))
+
+        invitation = container.get_invitation_by_code(u'CODE05')
+        assert_that(invitation, has_property('code', u'code05'))
+        assert_that(invitation.__parent__, is_(container.shard_for(u'code05')))
+        assert_that(container[u'code05'], is_(invitation))
+        assert_that(u'Code05' in container, is_(True))
+        # the location path can be resolved
+        shard = container.get_shard(invitation.__parent__.__name__)
+        assert_that(shard, is_(invitation.__parent__))
+        assert_that(shard[invitation.__name__], is_(invitation))
+        assert_that(container.get_shard(u'++shard++1'), is_(container.shards[1]))
+        assert_that(container.get_shard(u'++shard++9'), is_(none()))
+        assert_that(container.get_shard(u'code05'), is_(none()))
+        # codes only
+        assert_that(container.get(u'++shard++1'), is_(none()))
+        assert_that(container.get_invitation_by_code(u'++shard++1'), is_(none()))
+        with self.assertRaises(KeyError):
+            container[u'++shard++1']  # pylint: disable=pointless-statement
+        assert_that(container.get(None), is_(none()))
+
+        with self.assertRaises(DuplicateInvitationCodeError):
+            container.add(UserInvitation(code=u'CODE01'))
+        with self.assertRaises(DuplicateInvitationCodeError):
+            container.add_many([UserInvitation(code=u'code01')])
+
+        assert_that(container.remove(invitation), is_(True))
+        assert_that(container.remove(None), is_(False))
+        first, last = container[u'code00'], container[u'code19']
+        removed = container.remove_many([u'code19', u'code00', u'missing'])
+        assert_that(removed, is_([first, last]))
+        assert_that(first.__parent__, is_(none()))
+        del container[u'code01']
+        container[u'code01'] = UserInvitation(receiver=u'ichigo')
+        assert_that(container, has_length(18))
+
     def test_install_container(self):
         intids = fudge.Fake().provides('register')
         container = install_invitations_container(component, intids)
@@ -135,3 +498,58 @@ class TestModel(InvitationLayerTest):
         component.getGlobalSiteManager().unregisterUtility(
             container, IInvitationsContainer
         )
+
+    def test_reindex_invitations(self):
+        container = InvitationsContainer()
+        codes = (u'd', u'B', u'a', u'c', u'E')
+        for code in codes:
+            container.add(UserInvitation(code=code, receiver=u'ichigo',
+                                         site=u'dataserver2',
+                                         expiryTime=100))
+
+        class MockInt(object):
+            def queryId(self, obj):
+                # 'E' is not registered
+                return None if obj.code == u'E' else ord(obj.code.lower())
+
+            def register(self, unused_obj):
+                pass
+
+        intids = MockInt()
+        catalog = create_invitations_catalog(family=BTrees.family64)
+        del catalog[IX_EXPIRYTIME]
+
+        # selected index, stop after the first batch
+        count, checkpoint = reindex_invitations(container, catalog, intids,
+                                                indexes=(IX_EXPIRYTIME,),
+                                                batch_size=2, time_budget=0,
+                                                commit=False)
+        assert_that(count, is_(2))
+        assert_that(checkpoint, is_(u'B'))
+        assert_that(catalog, has_key(IX_EXPIRYTIME))
+        assert_that(catalog[IX_EXPIRYTIME].documentCount(), is_(2))
+        assert_that(catalog[IX_SITE].documentCount(), is_(0))
+        # queries do not use the index until it is complete
+        assert_that(index_ready(catalog, IX_EXPIRYTIME), is_(False))
+        assert_that(list(container.keys_after(checkpoint)),
+                    is_([u'c', u'd', u'E']))
+
+        # resume
+        count, checkpoint = reindex_invitations(container, catalog, intids,
+                                                indexes=(IX_EXPIRYTIME,),
+                                                batch_size=2,
+                                                checkpoint=checkpoint,
+                                                commit=False)
+        assert_that(count, is_(2))
+        assert_that(checkpoint, is_(none()))
+        assert_that(catalog[IX_EXPIRYTIME].documentCount(), is_(4))
+        assert_that(index_ready(catalog, IX_EXPIRYTIME), is_(True))
+        assert_that(catalog[IX_RECEIVER].documentCount(), is_(0))
+
+        # everything
+        generation = catalog.generation
+        count, checkpoint = reindex_invitations(container, catalog, intids,
+                                                commit=False)
+        assert_that(count, is_(4))
+        assert_that(catalog[IX_RECEIVER].documentCount(), is_(4))
+        assert_that(catalog.generation, is_(generation + 4))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import has_entries
+from hamcrest import assert_that
+
+from zope import component
+
+from zope.event import notify
+
+from nti.invitations.interfaces import InvitationSentEvent
+from nti.invitations.interfaces import IInvitationsStatistics
+from nti.invitations.interfaces import InvitationAcceptedEvent
+
+from nti.invitations.model import UserInvitation
+from nti.invitations.model import InvitationsContainer
+
+from nti.invitations.stats import STATE_SENT
+from nti.invitations.stats import STATE_TOTAL
+from nti.invitations.stats import STATE_ACCEPTED
+from nti.invitations.stats import STATE_UNACCEPTED
+
+from nti.invitations.stats import InvitationsStatistics
+
+from nti.invitations.stats import install_invitations_statistics
+from nti.invitations.stats import rebuild_invitations_statistics
+
+from nti.invitations.tests import InvitationLayerTest
+
+
+class TestStats(InvitationLayerTest):
+
+    def create_invitations(self):
+        return [UserInvitation(code=u'bleach', receiver=u'ichigo',
+                               sender=u'aizen', site=u'dataserver2'),
+                UserInvitation(code=u'zangetsu', receiver=u'ichigo',
+                               sender=u'aizen', site=u'dataserver2'),
+                UserInvitation(code=u'kido', receiver=u'rukia',
+                               sender=u'byakuya', site=u'seireitei')]
+
+    def test_change(self):
+        stats = InvitationsStatistics()
+        invitation = UserInvitation(code=u'bleach', receiver=u'ichigo',
+                                    sender=u'aizen', site=u'dataserver2')
+        stats.change(invitation, STATE_TOTAL)
+        stats.change(invitation, STATE_TOTAL)
+        stats.change(invitation, STATE_ACCEPTED)
+        assert_that(stats.count(STATE_TOTAL), is_(2))
+        assert_that(stats.count(STATE_TOTAL, site=u'dataserver2'), is_(2))
+        assert_that(stats.count(STATE_TOTAL, sender=u'aizen'), is_(2))
+        assert_that(stats.count(STATE_TOTAL, u'dataserver2', u'aizen'), is_(2))
+        assert_that(stats.count(STATE_TOTAL, site=u'xyz'), is_(0))
+        assert_that(stats.counts(site=u'dataserver2'),
+                    has_entries(STATE_TOTAL, 2,
+                                STATE_SENT, 0,
+                                STATE_ACCEPTED, 1,
+                                STATE_UNACCEPTED, 1))
+        stats.clear()
+        assert_that(stats.count(STATE_TOTAL), is_(0))
+
+    def test_subscribers(self):
+        stats = InvitationsStatistics()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(stats, IInvitationsStatistics)
+        try:
+            container = InvitationsContainer()
+            invitations = self.create_invitations()
+            for invitation in invitations:
+                container.add(invitation)
+            assert_that(stats.counts(),
+                        has_entries(STATE_TOTAL, 3, STATE_SENT, 0))
+            assert_that(stats.count(STATE_TOTAL, sender=u'aizen'), is_(2))
+
+            # sent counted once
+            notify(InvitationSentEvent(invitations[0], u'ichigo'))
+            notify(InvitationSentEvent(invitations[0], u'ichigo'))
+            assert_that(stats.count(STATE_SENT), is_(1))
+
+            invitations[0].acceptedTime = 100
+            notify(InvitationAcceptedEvent(invitations[0], u'ichigo'))
+            assert_that(stats.counts(site=u'dataserver2'),
+                        has_entries(STATE_ACCEPTED, 1, STATE_UNACCEPTED, 1))
+
+            # accepting again is not counted
+            notify(InvitationAcceptedEvent(invitations[0], u'ichigo', True))
+            assert_that(stats.count(STATE_ACCEPTED), is_(1))
+
+            container.remove(invitations[0])
+            assert_that(stats.counts(site=u'dataserver2'),
+                        has_entries(STATE_TOTAL, 1,
+                                    STATE_SENT, 0,
+                                    STATE_ACCEPTED, 0))
+
+            # bulk
+            container.remove_many(invitations[1:])
+            assert_that(stats.count(STATE_TOTAL), is_(0))
+            container.add_many(invitations, event=False)
+            assert_that(stats.counts(),
+                        has_entries(STATE_TOTAL, 3,
+                                    STATE_SENT, 1,
+                                    STATE_ACCEPTED, 1))
+
+            # rebuild
+            stats.clear()
+            rebuild_invitations_statistics(container, stats)
+            assert_that(stats.counts(sender=u'byakuya'),
+                        has_entries(STATE_TOTAL, 1, STATE_UNACCEPTED, 1))
+        finally:
+            gsm.unregisterUtility(stats, IInvitationsStatistics)
+
+    def test_install(self):
+        container = InvitationsContainer()
+        invitations = self.create_invitations()
+        container.add_many(invitations, event=False)
+        invitations[2].acceptedTime = 100
+        gsm = component.getGlobalSiteManager()
+        stats = install_invitations_statistics(component, container)
+        try:
+            assert_that(gsm.queryUtility(IInvitationsStatistics), is_(stats))
+            assert_that(stats.counts(),
+                        has_entries(STATE_TOTAL, 3, STATE_ACCEPTED, 1))
+            # installing again keeps the totals
+            assert_that(install_invitations_statistics(component), is_(stats))
+            assert_that(stats.count(STATE_TOTAL), is_(3))
+        finally:
+            gsm.unregisterUtility(stats, IInvitationsStatistics)
@@ -10,11 +10,26 @@ from __future__ import absolute_import
 from hamcrest import is_
 from hamcrest import none
 from hamcrest import is_not
+from hamcrest import contains
+from hamcrest import has_length
 from hamcrest import assert_that
 from hamcrest import has_property
 
+import BTrees
+
+from zope import component
+
+from zope.catalog.interfaces import ICatalog
+
 from zope.event import notify
 
+from zope.intid.interfaces import IIntIds
+
+from nti.invitations.index import IX_SENTTIME
+from nti.invitations.index import CATALOG_NAME
+
+from nti.invitations.index import create_invitations_catalog
+
 from nti.invitations.interfaces import InvitationSentEvent
 
 from nti.invitations.model import UserInvitation
@@ -32,3 +47,31 @@ class TestSubscribers(InvitationLayerTest):
         assert_that(shikai, has_property('sent', is_(none())))
         notify(InvitationSentEvent(shikai, 'zangetzu'))
         assert_that(shikai, has_property('sent', is_not(none())))
+
+    def test_reindex_sent(self):
+        shikai = UserInvitation(code=u'shikai',
+                                receiver=u'zangetzu',
+                                sender=u'ichigo')
+        catalog = create_invitations_catalog(family=BTrees.family64)
+        catalog.index_doc(1, shikai)
+        assert_that(catalog[IX_SENTTIME].documentCount(), is_(0))
+
+        class MockInt(object):
+            def queryId(self, unused_obj):
+                return 1
+
+        intids = MockInt()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        gsm.registerUtility(catalog, ICatalog, CATALOG_NAME)
+        try:
+            generation = catalog.generation
+            notify(InvitationSentEvent(shikai, u'zangetzu'))
+            assert_that(list(catalog[IX_SENTTIME].index.values_to_documents),
+                        has_length(1))
+            assert_that(catalog.generation, is_(generation + 1))
+            assert_that(catalog.apply({IX_SENTTIME: {'between': (0, shikai.sent)}}),
+                        contains(1))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+            gsm.unregisterUtility(catalog, ICatalog, CATALOG_NAME)
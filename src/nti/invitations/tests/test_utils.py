@@ -9,6 +9,9 @@ from __future__ import absolute_import
 
 from hamcrest import is_
 from hamcrest import none
+from hamcrest import is_not
+from hamcrest import has_key
+from hamcrest import has_item
 from hamcrest import has_length
 from hamcrest import assert_that
 
@@ -18,25 +21,50 @@ import BTrees
 
 import fudge
 
+from ZODB.POSException import ConflictError
+
 from zope import component
 
 from zope.intid.interfaces import IIntIds
 
+from nti.invitations.index import IX_SITE
+from nti.invitations.index import IX_ACCEPTED
+from nti.invitations.index import IX_ACCEPTEDTIME
+from nti.invitations.index import IX_SENTTIME
+from nti.invitations.index import IX_EFFECTIVE_EXPIRYTIME
+from nti.invitations.index import MissingIndexError
+from nti.invitations.index import add_missing_indexes
 from nti.invitations.index import create_invitations_catalog
 
+from nti.invitations.interfaces import IUserInvitation
+from nti.invitations.interfaces import IInvitationActor
 from nti.invitations.interfaces import InvitationActorError
 from nti.invitations.interfaces import IInvitationsContainer
 from nti.invitations.interfaces import InvitationExpiredError
+from nti.invitations.interfaces import IInvitationAcceptedEvent
 
 from nti.invitations.model import Invitation
 from nti.invitations.model import UserInvitation
 from nti.invitations.model import install_invitations_container
 
 from nti.invitations.utils import is_actionable
+from nti.invitations.utils import batch_iterable
+from nti.invitations.utils import get_site_names
+from nti.invitations.utils import safe_iterable
+from nti.invitations.utils import clear_site_names_cache
+from nti.invitations.utils import count_sent_invitations
+from nti.invitations.utils import count_pending_invitations
+from nti.invitations.utils import count_expired_invitations
+from nti.invitations.utils import count_accepted_invitations
+from nti.invitations.utils import prefetch_objects
 from nti.invitations.utils import get_invitations
 from nti.invitations.utils import accept_invitation
+from nti.invitations.utils import accept_invitations
 from nti.invitations.utils import get_invitation_actor
 from nti.invitations.utils import get_sent_invitations
+from nti.invitations.utils import get_accepted_invitations
+from nti.invitations.utils import explain_invitation_intids
+from nti.invitations.utils import get_unanswered_invitation_ids
 from nti.invitations.utils import get_invitation_intids
 from nti.invitations.utils import get_pending_invitations
 from nti.invitations.utils import get_expired_invitations
@@ -45,6 +73,15 @@ from nti.invitations.utils import delete_expired_invitations
 from nti.invitations.utils import get_expired_invitation_ids
 from nti.invitations.utils import get_pending_invitation_ids
 from nti.invitations.utils import get_random_invitation_code
+from nti.invitations.utils import get_sender_invitation_intids
+from nti.invitations.utils import get_receiver_invitation_intids
+from nti.invitations.utils import InvitationCodePrefixes
+from nti.invitations.utils import PrefixedInvitationCodeAllocator
+from nti.invitations.utils import sweep_expired_invitations
+from nti.invitations.utils import iter_sent_invitations
+from nti.invitations.utils import iter_pending_invitations
+from nti.invitations.utils import iter_expired_invitations
+from nti.invitations.utils import iter_accepted_invitations
 
 from nti.invitations.tests import InvitationLayerTest
 
@@ -56,7 +93,6 @@ class TestUtils(InvitationLayerTest):
         i1 = Invitation(code=u'bleach',
                         receiver=u'ichigo',
                         sender=u'aizen',
-                        accepted=False,
                         site=u"dataserver2",
                         expiryTime=0.0)
         catalog.index_doc(1, i1)
@@ -64,7 +100,6 @@ class TestUtils(InvitationLayerTest):
         i2 = Invitation(code=u'bleach2',
                         receiver=u'ichigo',
                         sender=u'aizen',
-                        accepted=False,
                         site=u"dataserver2",
                         expiryTime=time.time() - 2000)
         catalog.index_doc(2, i2)
@@ -72,7 +107,6 @@ class TestUtils(InvitationLayerTest):
         i3 = Invitation(code=u'bleach3',
                         receiver=u'ichigo',
                         sender=u'aizen',
-                        accepted=False,
                         site=u"dataserver2",
                         expiryTime=time.time() + 1000)
         catalog.index_doc(3, i3)
@@ -156,10 +190,55 @@ class TestUtils(InvitationLayerTest):
         result = get_expired_invitation_ids("aizen", catalog=catalog, mimeTypes="xyz")
         assert_that(result, has_length(0))
 
+    @fudge.patch('nti.invitations.utils.getSite',
+                 'nti.invitations.utils.get_component_hierarchy_names')
+    def test_get_site_names(self, mock_gs, mock_hn):
+        calls = []
+
+        def hierarchy():
+            calls.append(1)
+            return 'dataserver2 bleach'
+
+        mock_gs.is_callable().returns(object())
+        mock_hn.is_callable().calls(hierarchy)
+        names = get_site_names()
+        assert_that(names, is_(frozenset(('dataserver2', 'bleach'))))
+        # cached
+        assert_that(get_site_names(), is_(names))
+        assert_that(calls, has_length(1))
+        assert_that(safe_iterable(names), is_(names))
+        # site changed
+        mock_gs.is_callable().returns(object())
+        get_site_names()
+        assert_that(calls, has_length(2))
+        clear_site_names_cache()
+        get_site_names()
+        assert_that(calls, has_length(3))
+        clear_site_names_cache()
+
     def test_get_random_invitation_code(self):
         code = get_random_invitation_code()
         assert_that(code, has_length(14))
 
+    def test_prefixed_code_allocator(self):
+        prefixes = InvitationCodePrefixes()
+        allocator = PrefixedInvitationCodeAllocator(prefixes)
+        codes = [allocator.allocate() for _ in range(100)]
+        assert_that(set(codes), has_length(100))
+        assert_that(codes[0], has_length(24))
+        # reserved prefix and sequence, then random digits
+        assert_that(codes[0][:14], is_('0000-0100-0000'))
+        assert_that(codes[1][:14], is_('0000-0100-0001'))
+        assert_that(codes[0][14:], is_not(codes[1][14:]))
+        assert_that(codes, is_(sorted(codes)))
+        # forked process
+        allocator._pid = -1
+        assert_that(allocator.allocate()[:14], is_('0000-0200-0000'))
+        # exhausted sequence
+        allocator._next = 16 ** 6
+        assert_that(allocator.allocate()[:14], is_('0000-0300-0000'))
+        assert_that(prefixes.last, is_(3))
+
     def test_get_invitation_actor(self):
         invitation = UserInvitation(code='bleach',
                                     receiver='ichigo',
@@ -267,5 +346,387 @@ class TestUtils(InvitationLayerTest):
         fake_actor = fudge.Fake()
         fake_actor.provides("accept").returns(True)
         mock_ga.is_callable().returns(fake_actor)
-        assert_that(accept_invitation('ichigo', valid),
+        events = []
+
+        @component.adapter(IInvitationAcceptedEvent)
+        def _accepted(event):
+            events.append(event.was_accepted)
+        gsm = component.getGlobalSiteManager()
+        gsm.registerHandler(_accepted)
+        try:
+            assert_that(accept_invitation('ichigo', valid),
+                        is_(True))
+            assert_that(accept_invitation('ichigo', valid),
+                        is_(True))
+        finally:
+            gsm.unregisterHandler(_accepted)
+        assert_that(events, is_([False, True]))
+
+    def test_batch_iterable(self):
+        assert_that(list(batch_iterable(range(5), 2)),
+                    is_([[0, 1], [2, 3], [4]]))
+        assert_that(list(batch_iterable((), 2)), is_([]))
+
+    def test_iter_invitations(self):
+        catalog, invs = self.create_invitations()
+
+        class MockInt(object):
+            def queryObject(self, uid):
+                return invs[uid - 1]
+
+        intids = MockInt()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+
+        result = iter_pending_invitations(('ichigo',), catalog=catalog,
+                                          batch_size=1)
+        assert_that(sorted(result, key=lambda x: x.code),
+                    is_([invs[0], invs[2]]))
+
+        result = iter_expired_invitations(('ichigo',), catalog=catalog)
+        assert_that(list(result), is_([invs[1]]))
+
+        result = iter_accepted_invitations(('ichigo',), catalog=catalog)
+        assert_that(list(result), has_length(0))
+
+        result = iter_sent_invitations(('aizen',), catalog=catalog,
+                                       batch_size=2)
+        assert_that(list(result), has_length(3))
+
+        gsm.unregisterUtility(intids, IIntIds)
+
+    def test_prefetch_objects(self):
+        activated = []
+
+        class Ghost(object):
+            _p_changed = None
+
+            def __init__(self, jar):
+                self._p_jar = jar
+
+            def _p_activate(self):
+                activated.append(self)
+
+        class Jar(object):
+            prefetched = ()
+
+            def prefetch(self, objects):
+                self.prefetched = list(objects)
+
+        jar = Jar()
+        old_jar = object()  # no prefetch support
+        ghosts = [Ghost(jar), Ghost(jar), Ghost(old_jar)]
+        assert_that(prefetch_objects(ghosts + [None, UserInvitation()]),
+                    is_(3))
+        assert_that(jar.prefetched, is_(ghosts[:2]))
+        assert_that(activated, has_length(3))
+
+    def test_count_invitations(self):
+        catalog, invs = self.create_invitations()
+        # no intids utility is needed
+        assert_that(count_pending_invitations('ichigo', catalog=catalog),
+                    is_(2))
+        assert_that(count_pending_invitations(senders='aizen', catalog=catalog),
+                    is_(2))
+        assert_that(count_expired_invitations(catalog=catalog),
+                    is_(1))
+        assert_that(count_accepted_invitations(catalog=catalog),
+                    is_(0))
+        assert_that(count_sent_invitations('aizen', catalog=catalog),
+                    is_(3))
+        assert_that(count_sent_invitations('ichigo', catalog=catalog),
+                    is_(0))
+
+        invs[0].accepted = True
+        catalog.index_doc(1, invs[0])
+        assert_that(count_accepted_invitations(catalog=catalog),
+                    is_(1))
+        assert_that(count_pending_invitations(catalog=catalog),
+                    is_(1))
+
+    def test_has_pending_invitations_short_circuit(self):
+        catalog, invs = self.create_invitations()
+        # No intids utility is registered, so any attempt
+        # to load an object would fail
+        assert_that(has_pending_invitations(('aizen',), catalog=catalog),
+                    is_(False))
+        assert_that(has_pending_invitations(('ichigo',), sites='xyz', catalog=catalog),
+                    is_(False))
+
+        class MockInt(object):
+            def queryObject(self, uid):
+                return invs[uid - 1]
+
+        intids = MockInt()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        assert_that(has_pending_invitations(('ichigo',),
+                                            now=time.time() + 5000,
+                                            sites='dataserver2',
+                                            catalog=catalog),
                     is_(True))
+        gsm.unregisterUtility(intids, IIntIds)
+
+    def test_has_pending_invitations_filters_candidates(self):
+        catalog, invs = self.create_invitations()
+
+        def fail(*unused_args):
+            raise AssertionError("broad index applied")
+
+        # only the receiver index is applied, the others filter
+        for name in (IX_SITE, IX_ACCEPTED, IX_EFFECTIVE_EXPIRYTIME):
+            catalog[name].apply = fail
+
+        class MockInt(object):
+            def queryObject(self, uid):
+                return invs[uid - 1]
+
+        intids = MockInt()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            assert_that(has_pending_invitations(('ichigo',),
+                                                sites='dataserver2',
+                                                catalog=catalog),
+                        is_(True))
+            assert_that(has_pending_invitations(('aizen',),
+                                                sites='dataserver2',
+                                                catalog=catalog),
+                        is_(False))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+
+    def test_pending_without_effective_expiry_index(self):
+        catalog, _ = self.create_invitations()
+        del catalog[IX_EFFECTIVE_EXPIRYTIME]
+        result = get_pending_invitation_ids("ichigo", sites="dataserver2", catalog=catalog)
+        assert_that(sorted(result), is_([1, 3]))
+        assert_that(has_pending_invitations(('aizen',), catalog=catalog),
+                    is_(False))
+
+    def test_sweep_expired_invitations(self):
+        catalog, invs = self.create_invitations()
+        now = time.time()
+        i4 = Invitation(code=u'bleach4',
+                        receiver=u'ichigo',
+                        sender=u'aizen',
+                        site=u"dataserver2",
+                        expiryTime=now - 1000)
+        catalog.index_doc(4, i4)
+        invs += (i4,)
+
+        class MockInt(object):
+            def queryObject(self, uid):
+                return invs[uid - 1]
+
+            def register(self, obj):
+                pass
+
+        intids = MockInt()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+
+        container = install_invitations_container(component, intids)
+        try:
+            for invitation in invs:
+                container.add(invitation)
+
+            removed, checkpoint = sweep_expired_invitations(batch_size=1,
+                                                            time_budget=0,
+                                                            now=now,
+                                                            catalog=catalog,
+                                                            commit=False)
+            assert_that(removed, is_(['bleach2']))
+            assert_that(checkpoint, is_(2))
+
+            removed, checkpoint = sweep_expired_invitations(batch_size=1,
+                                                            checkpoint=checkpoint,
+                                                            now=now,
+                                                            catalog=catalog,
+                                                            commit=False)
+            assert_that(removed, is_(['bleach4']))
+            assert_that(checkpoint, is_(none()))
+            assert_that(container, has_length(2))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+            gsm.unregisterUtility(container, IInvitationsContainer)
+
+    @fudge.patch('nti.invitations.utils.transaction')
+    def test_sweep_expired_invitations_conflict(self, mock_tx):
+        catalog, invs = self.create_invitations()
+        mock_tx.provides('commit').raises(ConflictError())
+        mock_tx.provides('abort')
+
+        class MockInt(object):
+            def queryObject(self, uid):
+                return invs[uid - 1]
+
+            def register(self, obj):
+                pass
+
+        intids = MockInt()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        container = install_invitations_container(component, intids)
+        try:
+            for invitation in invs:
+                container.add(invitation)
+            removed, checkpoint = sweep_expired_invitations(catalog=catalog)
+            # nothing committed, resume from the aborted batch
+            assert_that(removed, is_([]))
+            assert_that(checkpoint, is_(1))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+            gsm.unregisterUtility(container, IInvitationsContainer)
+
+    def test_direct_invitation_intids(self):
+        catalog, invs = self.create_invitations()
+        invs[2].accepted = True
+        catalog.index_doc(3, invs[2])
+        for kwargs in ({},
+                       {'accepted': True},
+                       {'expired': True},
+                       {'sites': 'xyz'},
+                       {'mimeTypes': 'xyz'},
+                       {'sites': 'dataserver2', 'now': time.time() + 5000}):
+            for name, func in (('receivers', get_receiver_invitation_intids),
+                               ('senders', get_sender_invitation_intids)):
+                for value in ('ICHIGO', 'aizen', 'nobody'):
+                    expected = get_invitation_intids(catalog=catalog,
+                                                     **dict(kwargs, **{name: value}))
+                    result = func(value, catalog=catalog, **kwargs)
+                    assert_that(sorted(result), is_(sorted(expected or ())))
+
+    def test_accept_invitations(self):
+        _, invs = self.create_invitations()
+        valid, expired, other = invs
+        created = []
+
+        class Actor(object):
+            def __init__(self, invitation):
+                created.append(invitation)
+
+            def accept(self, unused_user, invitation):
+                return invitation is not other
+
+        gsm = component.getGlobalSiteManager()
+        gsm.registerAdapter(Actor, (IUserInvitation,), IInvitationActor)
+
+        now = time.time()
+        results = accept_invitations([(u'ichigo', valid),
+                                      (u'ichigo', expired),
+                                      (u'ichigo', other)],
+                                     now=now)
+        assert_that(results, has_length(3))
+        assert_that(results[0], is_((valid, True)))
+        assert_that(results[1][1], is_(InvitationExpiredError))
+        assert_that(results[2], is_((other, False)))
+        assert_that(valid.acceptedTime, is_(now))
+        assert_that(created, is_([valid, other]))
+
+        gsm.unregisterAdapter(Actor, (IUserInvitation,), IInvitationActor)
+
+        results = accept_invitations([(u'ichigo', other)])
+        assert_that(results[0][1], is_(InvitationActorError))
+
+    def test_accepted_time_window(self):
+        catalog, invs = self.create_invitations()
+        now = time.time()
+        for uid, (invitation, days) in enumerate(zip(invs, (1, 10, 30)), 1):
+            invitation.acceptedTime = now - days * 86400
+            catalog.index_doc(uid, invitation)
+
+        class MockInt(object):
+            def queryObject(self, uid):
+                return invs[uid - 1]
+
+        intids = MockInt()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            week_ago = now - 7 * 86400
+            assert_that(count_accepted_invitations(catalog=catalog), is_(3))
+            assert_that(count_accepted_invitations(catalog=catalog,
+                                                   accepted_after=week_ago),
+                        is_(1))
+            assert_that(count_accepted_invitations(catalog=catalog,
+                                                   accepted_before=week_ago),
+                        is_(2))
+            assert_that(get_accepted_invitations(catalog=catalog,
+                                                 accepted_after=now - 20 * 86400,
+                                                 accepted_before=week_ago),
+                        is_([invs[1]]))
+            # without the index
+            del catalog[IX_ACCEPTEDTIME]
+            assert_that(get_accepted_invitations(catalog=catalog,
+                                                 accepted_after=week_ago),
+                        is_([invs[0]]))
+            with self.assertRaises(MissingIndexError):
+                count_accepted_invitations(catalog=catalog, accepted_after=week_ago)
+            assert_that(count_accepted_invitations(catalog=catalog), is_(3))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+
+    def test_get_unanswered_invitation_ids(self):
+        catalog, invs = self.create_invitations()
+        now = time.time()
+        assert_that(get_unanswered_invitation_ids(now, catalog=catalog),
+                    has_length(0))
+        for uid, days in ((1, 10), (2, 10), (3, 1)):
+            invs[uid - 1].sent = now - days * 86400
+            catalog.index_doc(uid, invs[uid - 1])
+
+        # expired invitation 2 is not pending
+        three_days_ago = now - 3 * 86400
+        assert_that(list(get_unanswered_invitation_ids(three_days_ago,
+                                                       catalog=catalog)),
+                    is_([1]))
+        assert_that(get_unanswered_invitation_ids(now, catalog=catalog),
+                    has_length(2))
+        assert_that(get_unanswered_invitation_ids(now, sites=u'xyz',
+                                                  catalog=catalog),
+                    has_length(0))
+
+        invs[0].acceptedTime = now
+        # the accepted flag follows the accepted time
+        assert_that(invs[0].is_accepted(), is_(True))
+        catalog.index_doc(1, invs[0])
+        assert_that(get_unanswered_invitation_ids(three_days_ago,
+                                                  catalog=catalog),
+                    has_length(0))
+
+        del catalog[IX_SENTTIME]
+        with self.assertRaises(MissingIndexError):
+            get_unanswered_invitation_ids(now, catalog=catalog)
+
+    def test_explain_invitation_intids(self):
+        catalog, _ = self.create_invitations()
+        reports = explain_invitation_intids(receivers=u'ichigo', catalog=catalog)
+        assert_that(reports, has_length(1))
+        assert_that(reports[0]['result_size'], is_(2))
+        assert_that(reports[0]['query'], has_key(IX_EFFECTIVE_EXPIRYTIME))
+
+        # normalized receiver and site queries
+        reports = explain_invitation_intids(receivers=u'ICHIGO',
+                                            sites=u'dataserver2',
+                                            catalog=catalog)
+        assert_that(reports, has_length(1))
+        report = reports[0]
+        names = [x[1] for x in report['plan']]
+        assert_that(names, has_item('receiver'))
+        assert_that(names, has_item('site'))
+        assert_that(report['steps'], has_length(len(names)))
+        assert_that(report['result_size'], is_(2))
+
+        # older catalogs need two queries
+        del catalog[IX_EFFECTIVE_EXPIRYTIME]
+        reports = explain_invitation_intids(receivers=u'ichigo', catalog=catalog)
+        assert_that([x['result_size'] for x in reports], is_([1, 1]))
+
+        # and keep doing so until the new index is filled
+        add_missing_indexes(catalog)
+        reports = explain_invitation_intids(receivers=u'ichigo', catalog=catalog)
+        assert_that([x['result_size'] for x in reports], is_([1, 1]))
+        catalog.mark_ready()
+        reports = explain_invitation_intids(receivers=u'ichigo', catalog=catalog)
+        assert_that(reports[0]['query'], has_key(IX_EFFECTIVE_EXPIRYTIME))
@@ -25,7 +25,9 @@ from nti.invitations.model import install_invitations_container
 
 from nti.invitations.tests import InvitationLayerTest
 
+from nti.invitations.wref import resolve_many
 from nti.invitations.wref import InvitationWeakRef
+from nti.invitations.wref import get_invitations_container
 
 from nti.wref.interfaces import IWeakRef
 
@@ -63,3 +65,32 @@ class TestWref(InvitationLayerTest):
         component.getGlobalSiteManager().unregisterUtility(
             container, IInvitationsContainer
         )
+
+    def test_resolve_many(self):
+        intids = fudge.Fake().provides('register')
+        container = install_invitations_container(component, intids)
+        invitations = [UserInvitation(code=code, receiver=u'ichigo')
+                       for code in (u'zangetsu', u'bleach', u'kido')]
+        for invitation in invitations:
+            container.add(invitation)
+        refs = [IWeakRef(x) for x in invitations]
+        refs.append(IWeakRef(UserInvitation(code=u'missing')))
+        refs.append(refs[0])
+        assert_that(resolve_many(refs),
+                    is_(invitations + [None, invitations[0]]))
+        assert_that(resolve_many(()), is_([]))
+        component.getGlobalSiteManager().unregisterUtility(
+            container, IInvitationsContainer
+        )
+
+    def test_container_cache(self):
+        intids = fudge.Fake().provides('register')
+        container = install_invitations_container(component, intids)
+        assert_that(get_invitations_container(), is_(container))
+        assert_that(get_invitations_container(), is_(container))
+        gsm = component.getGlobalSiteManager()
+        gsm.unregisterUtility(container, IInvitationsContainer)
+        # registrations changed
+        other = install_invitations_container(component, intids)
+        assert_that(get_invitations_container(), is_(other))
+        gsm.unregisterUtility(other, IInvitationsContainer)
@@ -8,15 +8,23 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import os
 import time
 import uuid
-from datetime import datetime
+import threading
 
 from BTrees.LFBTree import LFSet
 
 import six
 
+from persistent import Persistent
+
+import transaction
+
+from ZODB.POSException import ConflictError
+
 from zope import component
+from zope import interface
 
 from zope.component.hooks import getSite
 
@@ -31,7 +39,16 @@ from nti.invitations.index import IX_MIMETYPE
 from nti.invitations.index import IX_SENDER
 from nti.invitations.index import IX_ACCEPTED
 from nti.invitations.index import IX_RECEIVER
+from nti.invitations.index import NEVER_EXPIRES
 from nti.invitations.index import IX_EXPIRYTIME
+from nti.invitations.index import IX_SENTTIME
+from nti.invitations.index import IX_ACCEPTEDTIME
+from nti.invitations.index import IX_EFFECTIVE_EXPIRYTIME
+from nti.invitations.index import MissingIndexError
+
+from nti.invitations.index import index_ready
+
+from nti.invitations.index import filter_doc_ids
 from nti.invitations.index import get_invitations_catalog
 
 from nti.invitations.interfaces import IInvitationActor
@@ -40,10 +57,27 @@ from nti.invitations.interfaces import IActionableInvitation
 from nti.invitations.interfaces import IInvitationsContainer
 from nti.invitations.interfaces import InvitationExpiredError
 from nti.invitations.interfaces import InvitationAcceptedEvent
+from nti.invitations.interfaces import InvitationValidationError
+from nti.invitations.interfaces import IInvitationCodeAllocator
+
+from nti.invitations.metrics import METRIC_ACCEPT
+from nti.invitations.metrics import METRIC_EXPIRED
+from nti.invitations.metrics import METRIC_ACCEPTED
+from nti.invitations.metrics import METRIC_OBJECTS_FILTERED
+from nti.invitations.metrics import METRIC_OBJECTS_ACTIVATED
+
+from nti.invitations.metrics import timed
+from nti.invitations.metrics import query_timed
+from nti.invitations.metrics import observe_size
+from nti.invitations.metrics import get_invitations_metrics
 
 from nti.site.site import get_component_hierarchy_names
 
-MAX_TS = time.mktime(datetime.max.timetuple())
+MAX_TS = NEVER_EXPIRES
+
+#: The number of intids resolved to objects at a time
+#: by the ``iter_*`` functions
+DEFAULT_BATCH_SIZE = 100
 
 logger = __import__('logging').getLogger(__name__)
 
@@ -51,6 +85,8 @@ logger = __import__('logging').getLogger(__name__)
 def safe_iterable(value, sep=','):
     if value is None:
         return None
+    if isinstance(value, frozenset) and None not in value:
+        return value  # precomputed
     if isinstance(value, six.string_types):
         value = value.split(sep)
     value = set(value)
@@ -58,12 +94,137 @@ def safe_iterable(value, sep=','):
     return value
 
 
+class _SiteNamesCache(threading.local):
+    site = None
+    names = None
+
+_site_names_cache = _SiteNamesCache()
+
+
+def get_site_names():
+    """
+    Return the names of the sites in the hierarchy of the current site.
+
+    The result is cached per thread and recomputed when the current site
+    changes. Being a frozenset, it can be passed as the ``sites`` of the
+    query functions as is.
+    """
+    site = getSite()
+    cache = _site_names_cache
+    if cache.names is None or cache.site is not site:
+        names = get_component_hierarchy_names()
+        names = names.split() if isinstance(names, six.string_types) else names
+        cache.site, cache.names = site, frozenset(names or ())
+    return cache.names
+
+
+def clear_site_names_cache():
+    """
+    Forget the site names cached by :func:`get_site_names`, for
+    example after the site hierarchy has changed.
+    """
+    _site_names_cache.site = _site_names_cache.names = None
+
+
+def batch_iterable(iterable, size=DEFAULT_BATCH_SIZE):
+    """
+    Yield lists of at most ``size`` items taken from ``iterable``.
+    """
+    size = max(1, size or DEFAULT_BATCH_SIZE)
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def get_random_invitation_code():
     s = str(uuid.uuid4()).split('-')[-1].upper()
     result = s[0:4] + '-' + s[4:8] + '-' + s[8:]
     return text_(result)
 
 
+class InvitationCodePrefixes(Persistent):
+    """
+    The persistent record of the code prefixes reserved by
+    :class:`PrefixedInvitationCodeAllocator`. Concurrent reservations
+    conflict instead of being merged, so that a prefix is never
+    reserved twice.
+    """
+
+    last = 0
+
+    def reserve(self):
+        self.last += 1
+        return self.last
+
+
+@interface.implementer(IInvitationCodeAllocator)
+class PrefixedInvitationCodeAllocator(object):
+    """
+    Allocates codes made of a prefix reserved for the process in the
+    given :class:`InvitationCodePrefixes`, a sequence number and random
+    digits, in groups of four like :func:`get_random_invitation_code`.
+
+    A prefix is reserved the first time a code is needed, in forked
+    processes and when the sequence is exhausted. Reservations are
+    committed in their own transaction, so the codes are unique across
+    processes without reading the container. Consecutive codes of a
+    process sort together, so concurrent processes insert into different
+    container buckets, and the random digits keep the codes from being
+    guessed from one another.
+    """
+
+    prefix_digits = 6
+    sequence_digits = 6
+    random_digits = 8
+
+    #: The number of times a conflicting reservation is attempted
+    reserve_attempts = 5
+
+    def __init__(self, prefixes):
+        self.prefixes = prefixes
+        self._lock = threading.Lock()
+        self._pid = None
+        self._prefix = None
+        self._next = 0
+
+    def _reserve(self):
+        prefixes = self.prefixes
+        jar = getattr(prefixes, '_p_jar', None)
+        if jar is None:
+            # not stored, e.g. in tests
+            return prefixes.reserve()
+        # the reservation must survive the transaction needing the code
+        manager = transaction.TransactionManager()
+        connection = jar.db().open(transaction_manager=manager)
+        try:
+            for attempt in manager.attempts(self.reserve_attempts):
+                with attempt:
+                    result = connection.get(prefixes._p_oid).reserve()
+            return result
+        finally:
+            connection.close()
+
+    def allocate(self):
+        with self._lock:
+            if     self._pid != os.getpid() \
+                or self._next >= 16 ** self.sequence_digits:
+                self._prefix = '%0*X' % (self.prefix_digits, self._reserve())
+                self._pid = os.getpid()
+                self._next = 0
+            number = self._next
+            self._next += 1
+        s = self._prefix \
+            + '%0*X' % (self.sequence_digits, number) \
+            + uuid.uuid4().hex[:self.random_digits].upper()
+        result = '-'.join(s[x:x + 4] for x in range(0, len(s), 4))
+        return text_(result)
+
+
 def get_invitation_actor(invitation, user=None):
     actor = component.queryMultiAdapter((invitation, user), IInvitationActor)
     if actor is None:
@@ -75,6 +236,77 @@ def is_actionable(obj):
     return IActionableInvitation.providedBy(obj)
 
 
+def prefetch_objects(objects):
+    """
+    Load the state of the given ghost objects in as few storage round
+    trips as possible and activate them.
+
+    Ghosts are grouped by connection and handed to the connection's
+    ``prefetch`` method when it has one (ZODB 5); the storage decides
+    whether it can bulk-load them. Otherwise each ghost is simply
+    activated on its own.
+
+    :return: The number of activated ghosts.
+    """
+    ghosts = {}
+    for obj in objects:
+        jar = getattr(obj, '_p_jar', None)
+        # _p_changed is None only for ghosts
+        if jar is not None and getattr(obj, '_p_changed', False) is None:
+            ghosts.setdefault(id(jar), (jar, []))[1].append(obj)
+    count = 0
+    for jar, batch in ghosts.values():
+        prefetch = getattr(jar, 'prefetch', None)
+        if prefetch is not None:
+            prefetch(batch)
+        for obj in batch:
+            obj._p_activate()  # pylint: disable=protected-access
+        count += len(batch)
+    return count
+
+
+def resolve_invitations(doc_ids, intids=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Lazily resolve the given intids to actionable invitations,
+    ``batch_size`` intids at a time. Each batch is prefetched
+    with :func:`prefetch_objects` before it is yielded.
+
+    The catalog must not be modified while the returned
+    generator is being consumed.
+    """
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    metrics = get_invitations_metrics()
+    for batch in batch_iterable(doc_ids or (), batch_size):
+        objects = [intids.queryObject(uid) for uid in batch]
+        metrics.incr(METRIC_OBJECTS_ACTIVATED, prefetch_objects(objects))
+        filtered = 0
+        for obj in objects:
+            if is_actionable(obj):
+                yield obj
+            else:
+                filtered += 1
+        if filtered:
+            metrics.incr(METRIC_OBJECTS_FILTERED, filtered)
+
+
+def iter_all_invitations(sites=None,
+                         receivers=None,
+                         senders=None,
+                         catalog=None,
+                         mimeTypes=None,
+                         batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Iterate all invitations via our current site.
+    """
+    doc_ids = get_all_invitation_intids(sites=sites,
+                                        receivers=receivers,
+                                        senders=senders,
+                                        catalog=catalog,
+                                        mimeTypes=mimeTypes)
+    return resolve_invitations(doc_ids, batch_size=batch_size)
+iter_invitations = iter_all_invitations
+
+
 def get_all_invitations(sites=None,
                         receivers=None,
                         senders=None,
@@ -83,18 +315,11 @@ def get_all_invitations(sites=None,
     """
     Get all invitations via our current site.
     """
-    result = []
-    intids = component.getUtility(IIntIds)
-    doc_ids = get_all_invitation_intids(sites=sites,
-                                        receivers=receivers,
-                                        senders=senders,
-                                        catalog=catalog,
-                                        mimeTypes=mimeTypes)
-    for uid in doc_ids or ():
-        obj = intids.queryObject(uid)
-        if is_actionable(obj):
-            result.append(obj)
-    return result
+    return list(iter_all_invitations(sites=sites,
+                                     receivers=receivers,
+                                     senders=senders,
+                                     catalog=catalog,
+                                     mimeTypes=mimeTypes))
 get_invitations = get_all_invitations
 
 
@@ -108,8 +333,7 @@ def _build_invitation_query(receivers=None,
     sites = safe_iterable(sites)
     query = dict()
     if not sites and getSite() is not None:
-        sites = get_component_hierarchy_names()
-        sites = sites.split() if isinstance(sites, six.string_types) else sites
+        sites = get_site_names()
     if not sites:
         # tets
         sites = ['dataserver2',]
@@ -134,7 +358,28 @@ def get_all_invitation_intids(receivers=None,
     """
     query = _build_invitation_query(receivers, senders, sites, mimeTypes)
     catalog = get_invitations_catalog() if catalog is None else catalog
-    return catalog.apply(query)
+    with query_timed('all') as metrics:
+        result = catalog.apply(query)
+    observe_size(metrics, 'all', result)
+    return result
+
+
+def pending_expiry_queries(catalog, now=None):
+    """
+    Return the ``(index name, index query)`` pairs whose union are the
+    invitations that have not expired at ``now``.
+
+    Catalogs with a ready :data:`~nti.invitations.index.IX_EFFECTIVE_EXPIRYTIME`
+    index need a single range query; older catalogs need one query for
+    the invitations that never expire and one for those that expire
+    after ``now``.
+    """
+    now = time.time() if not now else now
+    if index_ready(catalog, IX_EFFECTIVE_EXPIRYTIME):
+        return ((IX_EFFECTIVE_EXPIRYTIME, {'between': (now, MAX_TS)}),)
+    # pending no expiry, then pending with expiration
+    return ((IX_EXPIRYTIME, {'any_of': (0,)}),
+            (IX_EXPIRYTIME, {'between': (now, MAX_TS)}))
 
 
 def get_invitation_intids(receivers=None,
@@ -144,34 +389,191 @@ def get_invitation_intids(receivers=None,
                           catalog=None,
                           mimeTypes=None,
                           accepted=False,
-                          expired=False):
+                          expired=False,
+                          accepted_after=None,
+                          accepted_before=None):
     """
     Get invitation intids by site and mimetype. By default, 
     pending invitations (not accepted and not expired) are returned.
+
+    Accepted invitations can be restricted to those accepted
+    between ``accepted_after`` and ``accepted_before``.
+
+    :raises MissingIndexError: If a window is given and the catalog has
+        no ready accepted time index.
+    """
+    kind = 'accepted' if accepted else ('expired' if expired else 'pending')
+    with query_timed(kind) as metrics:
+        result = _get_invitation_intids(receivers, senders, sites, now,
+                                        catalog, mimeTypes, accepted, expired,
+                                        accepted_after, accepted_before)
+    observe_size(metrics, kind, result)
+    return result
+get_pending_invitation_ids = get_invitation_intids
+
+
+def _invitation_queries(receivers, senders, sites, now, catalog, mimeTypes,
+                        accepted, expired, accepted_after, accepted_before):
+    """
+    Return the catalog queries whose union are the requested intids.
     """
     query = _build_invitation_query(receivers, senders, sites, mimeTypes)
-    catalog = get_invitations_catalog() if catalog is None else catalog
     query[IX_ACCEPTED] = {'any_of': (accepted,)}
     now = time.time() if not now else now
-    
+
     if accepted:
         # Accepted
-        result = catalog.apply(query)
+        if accepted_after is not None or accepted_before is not None:
+            if not index_ready(catalog, IX_ACCEPTEDTIME):
+                raise MissingIndexError(IX_ACCEPTEDTIME)
+            query[IX_ACCEPTEDTIME] = {
+                'between': (accepted_after or 0, accepted_before or MAX_TS)
+            }
+        return [query]
     elif expired:
         query[IX_EXPIRYTIME] = {'between': (60, now)}
-        result = catalog.apply(query)
-    else:
-        # Pending
-        query[IX_EXPIRYTIME] = {'any_of': (0,)}
-        # pending no expiry
-        no_expire_ids = catalog.apply(query) or LFSet()
-        # pending with expiration
-        query[IX_EXPIRYTIME] = {'between': (now, MAX_TS)}
-        in_between_ids = catalog.apply(query) or LFSet()
-        # return union
-        result = catalog.family.IF.multiunion([no_expire_ids, in_between_ids])
+        return [query]
+    # Pending
+    result = []
+    for name, expiry_query in pending_expiry_queries(catalog, now):
+        result.append(dict(query, **{name: expiry_query}))
     return result
-get_pending_invitation_ids = get_invitation_intids
+
+
+def _get_invitation_intids(receivers, senders, sites, now, catalog, mimeTypes,
+                           accepted, expired, accepted_after, accepted_before):
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    queries = _invitation_queries(receivers, senders, sites, now, catalog,
+                                  mimeTypes, accepted, expired,
+                                  accepted_after, accepted_before)
+    if accepted or expired:
+        return catalog.apply(queries[0])
+    results = [catalog.apply(query) or LFSet() for query in queries]
+    if len(results) == 1:
+        return results[0]
+    return catalog.family.IF.multiunion(results)
+
+
+def explain_invitation_intids(receivers=None,
+                              senders=None,
+                              sites=None,
+                              now=None,
+                              catalog=None,
+                              mimeTypes=None,
+                              accepted=False,
+                              expired=False,
+                              accepted_after=None,
+                              accepted_before=None):
+    """
+    Evaluate the catalog queries of :func:`get_invitation_intids` with
+    the same arguments and return their
+    :meth:`~nti.invitations.index.InvitationsCatalog.explain` reports.
+    The requested intids are the union of the query results.
+    """
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    queries = _invitation_queries(receivers, senders, sites, now, catalog,
+                                  mimeTypes, accepted, expired,
+                                  accepted_after, accepted_before)
+    return [catalog.explain(query) for query in queries]
+
+
+def iter_pending_invitations(receivers=None,
+                             sites=None,
+                             now=None,
+                             catalog=None,
+                             mimeTypes=None,
+                             batch_size=DEFAULT_BATCH_SIZE):
+    doc_ids = get_pending_invitation_ids(receivers=receivers,
+                                         sites=sites,
+                                         now=now,
+                                         catalog=catalog,
+                                         mimeTypes=mimeTypes)
+    return resolve_invitations(doc_ids, batch_size=batch_size)
+
+
+def _get_direct_invitation_intids(name, values, sites=None, now=None,
+                                  catalog=None, mimeTypes=None,
+                                  accepted=False, expired=False):
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    family = catalog.family
+    # read the postings of the normalized values
+    index = catalog[name]
+    postings = index.index.values_to_documents
+    doc_ids = []
+    for value in safe_iterable(values) or ():
+        # normalizers return the sequence of matching values
+        for key in index.normalizer.any(value, index.index):
+            docs = postings.get(key)
+            if docs is not None:
+                doc_ids.append(docs)
+    doc_ids = family.IF.multiunion(doc_ids)
+    if not doc_ids:
+        return doc_ids
+
+    def check(doc_ids, name, index_query):
+        result = filter_doc_ids(catalog[name], index_query, doc_ids, family)
+        if result is None:
+            result = family.IF.intersection(doc_ids,
+                                            catalog[name].apply(index_query))
+        return result
+
+    query = _build_invitation_query(sites=sites, mimeTypes=mimeTypes)
+    query[IX_ACCEPTED] = {'any_of': (accepted,)}
+    for name, index_query in query.items():
+        doc_ids = check(doc_ids, name, index_query)
+        if not doc_ids:
+            return doc_ids
+    if accepted:
+        return doc_ids
+    now = time.time() if not now else now
+    if expired:
+        expiry_queries = ((IX_EXPIRYTIME, {'between': (60, now)}),)
+    else:
+        expiry_queries = pending_expiry_queries(catalog, now)
+    return family.IF.multiunion([check(doc_ids, name, index_query)
+                                 for name, index_query in expiry_queries])
+
+
+def get_receiver_invitation_intids(receivers,
+                                   sites=None,
+                                   now=None,
+                                   catalog=None,
+                                   mimeTypes=None,
+                                   accepted=False,
+                                   expired=False):
+    """
+    Same as ``get_invitation_intids(receivers=receivers, ...)``, but the
+    invitations of the receivers are read straight from the receiver index
+    and only those are filtered by site and state.
+    """
+    return _get_direct_invitation_intids(IX_RECEIVER, receivers,
+                                         sites=sites,
+                                         now=now,
+                                         catalog=catalog,
+                                         mimeTypes=mimeTypes,
+                                         accepted=accepted,
+                                         expired=expired)
+
+
+def get_sender_invitation_intids(senders,
+                                 sites=None,
+                                 now=None,
+                                 catalog=None,
+                                 mimeTypes=None,
+                                 accepted=False,
+                                 expired=False):
+    """
+    Same as ``get_invitation_intids(senders=senders, ...)``, but the
+    invitations of the senders are read straight from the sender index
+    and only those are filtered by site and state.
+    """
+    return _get_direct_invitation_intids(IX_SENDER, senders,
+                                         sites=sites,
+                                         now=now,
+                                         catalog=catalog,
+                                         mimeTypes=mimeTypes,
+                                         accepted=accepted,
+                                         expired=expired)
 
 
 def get_pending_invitations(receivers=None,
@@ -179,49 +581,124 @@ def get_pending_invitations(receivers=None,
                             now=None,
                             catalog=None,
                             mimeTypes=None):
-    result = []
-    intids = component.getUtility(IIntIds)
-    doc_ids = get_pending_invitation_ids(receivers=receivers,
+    return list(iter_pending_invitations(receivers=receivers,
                                          sites=sites,
                                          now=now,
                                          catalog=catalog,
-                                         mimeTypes=mimeTypes)
-    for uid in doc_ids or ():
-        obj = intids.queryObject(uid)
-        if is_actionable(obj):
-            result.append(obj)
-    return result
+                                         mimeTypes=mimeTypes))
 
 
-def get_accepted_invitations(receivers=None,
-                             sites=None,
-                             now=None,
-                             catalog=None,
-                             mimeTypes=None):
-    result = []
-    intids = component.getUtility(IIntIds)
+def iter_accepted_invitations(receivers=None,
+                              sites=None,
+                              now=None,
+                              catalog=None,
+                              mimeTypes=None,
+                              batch_size=DEFAULT_BATCH_SIZE,
+                              accepted_after=None,
+                              accepted_before=None):
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    window = (accepted_after, accepted_before)
+    filtered = window != (None, None) \
+        and not index_ready(catalog, IX_ACCEPTEDTIME)
+    after, before = (None, None) if filtered else window
     doc_ids = get_invitation_intids(receivers=receivers,
                                     sites=sites,
                                     now=now,
                                     accepted=True,
                                     catalog=catalog,
-                                    mimeTypes=mimeTypes)
-    for uid in doc_ids or ():
-        obj = intids.queryObject(uid)
-        if is_actionable(obj):
-            result.append(obj)
+                                    mimeTypes=mimeTypes,
+                                    accepted_after=after,
+                                    accepted_before=before)
+    result = resolve_invitations(doc_ids, batch_size=batch_size)
+    if filtered:
+        # no ready index, check the objects
+        low, high = accepted_after or 0, accepted_before or MAX_TS
+        result = (x for x in result
+                  if x.acceptedTime is not None and low <= x.acceptedTime <= high)
+    return result
+
+
+def get_accepted_invitations(receivers=None,
+                             sites=None,
+                             now=None,
+                             catalog=None,
+                             mimeTypes=None,
+                             accepted_after=None,
+                             accepted_before=None):
+    return list(iter_accepted_invitations(receivers=receivers,
+                                          sites=sites,
+                                          now=now,
+                                          catalog=catalog,
+                                          mimeTypes=mimeTypes,
+                                          accepted_after=accepted_after,
+                                          accepted_before=accepted_before))
+
+
+#: The order in which :func:`has_pending_invitations` probes the
+#: indexes, cheapest and most selective first
+PENDING_PROBE_ORDER = (IX_RECEIVER,
+                       IX_SENDER,
+                       IX_MIMETYPE,
+                       IX_ACCEPTED,
+                       IX_SITE)
+
+
+def _filter_or_apply(catalog, name, index_query, doc_ids):
+    """
+    Return the ``doc_ids`` matching ``index_query`` on the named index,
+    checking their indexed values rather than applying the index.
+    """
+    family = catalog.family
+    result = filter_doc_ids(catalog[name], index_query, doc_ids, family)
+    if result is None:
+        ids = catalog[name].apply(index_query)
+        result = doc_ids if ids is None else family.IF.intersection(doc_ids, ids)
+    return result
+
+
+def apply_in_order(catalog, query, order):
+    """
+    Evaluate the indexes of ``query`` one at a time in the given ``order``
+    and stop as soon as the running result is empty. Only the first index
+    is applied; the following ones filter the running result document by
+    document, so broad indexes are never materialized. Indexes not named
+    in ``order`` are ignored.
+    """
+    result = None
+    for name in order:
+        if name not in query:
+            continue
+        if result is None:
+            result = catalog[name].apply(query[name])
+        else:
+            result = _filter_or_apply(catalog, name, query[name], result)
+        if result is not None and not result:
+            break
     return result
 
 
 def has_pending_invitations(receivers=None, sites=None, now=None, catalog=None):
-    intids = component.getUtility(IIntIds)
-    doc_ids = get_pending_invitation_ids(receivers=receivers,
-                                         sites=sites,
-                                         now=now,
-                                         catalog=catalog)
-    for uid in doc_ids or ():
-        obj = intids.queryObject(uid)
-        if is_actionable(obj):
+    """
+    Return true if there is at least one pending invitation.
+
+    Unlike :func:`get_pending_invitation_ids`, the indexes are probed
+    following :data:`PENDING_PROBE_ORDER` and the search stops at the
+    first empty intersection or the first actionable invitation found.
+    """
+    with query_timed('has_pending'):
+        return _has_pending_invitations(receivers, sites, now, catalog)
+
+
+def _has_pending_invitations(receivers, sites, now, catalog):
+    query = _build_invitation_query(receivers=receivers, sites=sites)
+    query[IX_ACCEPTED] = {'any_of': (False,)}
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    candidates = apply_in_order(catalog, query, PENDING_PROBE_ORDER)
+    if not candidates:
+        return False
+    for name, expiry_query in pending_expiry_queries(catalog, now):
+        ids = _filter_or_apply(catalog, name, expiry_query, candidates)
+        for _ in resolve_invitations(ids, batch_size=1):
             return True
     return False
 
@@ -230,23 +707,30 @@ def get_expired_invitation_ids(*args, **kwargs):
     return get_invitation_intids(expired=True, *args, **kwargs)
 
 
+def iter_expired_invitations(receivers=None,
+                             sites=None,
+                             now=None,
+                             catalog=None,
+                             mimeTypes=None,
+                             batch_size=DEFAULT_BATCH_SIZE):
+    doc_ids = get_expired_invitation_ids(receivers=receivers,
+                                         sites=sites,
+                                         now=now,
+                                         catalog=catalog,
+                                         mimeTypes=mimeTypes)
+    return resolve_invitations(doc_ids, batch_size=batch_size)
+
+
 def get_expired_invitations(receivers=None,
                             sites=None,
                             now=None,
                             catalog=None,
                             mimeTypes=None):
-    result = []
-    intids = component.getUtility(IIntIds)
-    doc_ids = get_expired_invitation_ids(receivers=receivers,
+    return list(iter_expired_invitations(receivers=receivers,
                                          sites=sites,
                                          now=now,
                                          catalog=catalog,
-                                         mimeTypes=mimeTypes)
-    for uid in doc_ids or ():
-        obj = intids.queryObject(uid)
-        if is_actionable(obj):
-            result.append(obj)
-    return result
+                                         mimeTypes=mimeTypes))
 
 
 def delete_expired_invitations(receivers=None,
@@ -256,14 +740,131 @@ def delete_expired_invitations(receivers=None,
                                mimeTypes=None):
     result = []
     container = component.getUtility(IInvitationsContainer)
-    invitations = get_expired_invitations(receivers=receivers,
-                                          sites=sites,
-                                          now=now,
-                                          catalog=catalog,
-                                          mimeTypes=mimeTypes)
-    for invitation in invitations:
-        if container.remove(invitation):
-            result.append(invitation)
+    with timed('%s.delete' % METRIC_EXPIRED) as metrics:
+        invitations = get_expired_invitations(receivers=receivers,
+                                              sites=sites,
+                                              now=now,
+                                              catalog=catalog,
+                                              mimeTypes=mimeTypes)
+        for invitation in invitations:
+            if container.remove(invitation):
+                result.append(invitation)
+    metrics.incr('%s.removed' % METRIC_EXPIRED, len(result))
+    return result
+
+
+def sweep_expired_invitations(batch_size=DEFAULT_BATCH_SIZE,
+                              time_budget=None,
+                              checkpoint=None,
+                              receivers=None,
+                              sites=None,
+                              now=None,
+                              catalog=None,
+                              mimeTypes=None,
+                              commit=True):
+    """
+    Remove expired invitations ``batch_size`` at a time, committing the
+    current transaction after each batch if ``commit`` is true.
+
+    Expired intids are visited in increasing order. ``checkpoint`` is the
+    last intid visited by a previous sweep; visiting resumes right after
+    it. If ``time_budget`` is given, the sweep stops once that many
+    seconds have elapsed at the end of a batch. If committing a batch
+    fails with a conflict, the batch is aborted and the sweep stops.
+
+    :return: A tuple with the codes of the invitations removed by the
+        committed batches and the checkpoint to resume from, or ``None``
+        if the sweep completed.
+    """
+    with timed('%s.sweep' % METRIC_EXPIRED) as metrics:
+        return _sweep_expired_invitations(batch_size, time_budget, checkpoint,
+                                          receivers, sites, now, catalog,
+                                          mimeTypes, commit, metrics)
+
+
+def _sweep_expired_invitations(batch_size, time_budget, checkpoint,
+                               receivers, sites, now, catalog, mimeTypes,
+                               commit, metrics):
+    start = time.time()
+    now = start if not now else now
+    container = component.getUtility(IInvitationsContainer)
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    doc_ids = get_expired_invitation_ids(receivers=receivers,
+                                         sites=sites,
+                                         now=now,
+                                         catalog=catalog,
+                                         mimeTypes=mimeTypes)
+    # take a snapshot, the catalog changes as we remove
+    doc_ids = catalog.family.IF.Set(doc_ids or ())
+    if checkpoint is not None:
+        doc_ids = doc_ids.keys(checkpoint, excludemin=True)
+    removed = []
+    for batch in batch_iterable(doc_ids, batch_size):
+        codes = []
+        for invitation in resolve_invitations(batch, batch_size=batch_size):
+            # removing clears the name, which is the code
+            code = invitation.code
+            if container.remove(invitation):
+                codes.append(code)
+        if commit:
+            try:
+                transaction.commit()
+            except ConflictError:
+                transaction.abort()
+                # resume with the first intid of the aborted batch
+                checkpoint = batch[0] - 1
+                logger.warning("Conflict while removing expired invitations, "
+                               "%s removed, stopped at %s",
+                               len(removed), checkpoint)
+                return removed, checkpoint
+        removed.extend(codes)
+        metrics.incr('%s.removed' % METRIC_EXPIRED, len(codes))
+        checkpoint = batch[-1]
+        elapsed = time.time() - start
+        if time_budget is not None and elapsed >= time_budget:
+            logger.info("%s expired invitation(s) removed in %.2f(s), stopped at %s",
+                        len(removed), elapsed, checkpoint)
+            return removed, checkpoint
+    logger.info("%s expired invitation(s) removed in %.2f(s)",
+                len(removed), time.time() - start)
+    return removed, None
+
+
+def get_unanswered_invitation_ids(sent_before,
+                                  sites=None,
+                                  receivers=None,
+                                  senders=None,
+                                  now=None,
+                                  catalog=None,
+                                  mimeTypes=None):
+    """
+    Get the intids of the pending invitations that were sent before
+    ``sent_before`` and have not been accepted. Invitations that were
+    never sent are not returned.
+
+    Catalogs created before the sent time index existed get it, along
+    with the sent times of the invitations sent before then, from
+    ``reindex_invitations(container, indexes=(IX_SENTTIME,))``.
+
+    :raises MissingIndexError: If the catalog has no sent time index or
+        it is still being built.
+    """
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    if not index_ready(catalog, IX_SENTTIME):
+        raise MissingIndexError(IX_SENTTIME)
+    query = _build_invitation_query(receivers, senders, sites, mimeTypes)
+    query[IX_ACCEPTED] = {'any_of': (False,)}
+    query[IX_SENTTIME] = {'between': (0, sent_before)}
+    with query_timed('unanswered') as metrics:
+        results = []
+        for name, expiry_query in pending_expiry_queries(catalog, now):
+            query[name] = expiry_query
+            results.append(catalog.apply(query) or LFSet())
+        if len(results) == 1:
+            result = results[0]
+        else:
+            result = catalog.family.IF.multiunion(results)
+    observe_size(metrics, 'unanswered', result)
     return result
 
 
@@ -288,8 +889,24 @@ def get_sent_invitation_ids(senders,
         if values is not None:
             query[name] = {'any_of': values}
 
-    expired_ids = catalog.apply(query) or LFSet()
-    return expired_ids
+    with query_timed('sent') as metrics:
+        result = catalog.apply(query) or LFSet()
+    observe_size(metrics, 'sent', result)
+    return result
+
+
+def iter_sent_invitations(senders,
+                          sites=None,
+                          accepted=False,
+                          catalog=None,
+                          mimeTypes=None,
+                          batch_size=DEFAULT_BATCH_SIZE):
+    doc_ids = get_sent_invitation_ids(senders,
+                                      sites,
+                                      accepted,
+                                      catalog,
+                                      mimeTypes)
+    return resolve_invitations(doc_ids, batch_size=batch_size)
 
 
 def get_sent_invitations(senders,
@@ -297,30 +914,163 @@ def get_sent_invitations(senders,
                          accepted=False,
                          catalog=None,
                          mimeTypes=None):
-    result = []
-    intids = component.getUtility(IIntIds)
+    return list(iter_sent_invitations(senders,
+                                      sites,
+                                      accepted,
+                                      catalog,
+                                      mimeTypes))
+
+
+def count_pending_invitations(receivers=None,
+                              senders=None,
+                              sites=None,
+                              now=None,
+                              catalog=None,
+                              mimeTypes=None):
+    """
+    Return the number of pending invitations. Only the catalog
+    is consulted; no invitation object is loaded.
+    """
+    doc_ids = get_pending_invitation_ids(receivers=receivers,
+                                         senders=senders,
+                                         sites=sites,
+                                         now=now,
+                                         catalog=catalog,
+                                         mimeTypes=mimeTypes)
+    return len(doc_ids or ())
+
+
+def count_accepted_invitations(receivers=None,
+                               senders=None,
+                               sites=None,
+                               catalog=None,
+                               mimeTypes=None,
+                               accepted_after=None,
+                               accepted_before=None):
+    """
+    Return the number of accepted invitations. Only the catalog
+    is consulted; no invitation object is loaded.
+
+    :raises MissingIndexError: If a window is given and the catalog has
+        no ready accepted time index.
+    """
+    doc_ids = get_invitation_intids(receivers=receivers,
+                                    senders=senders,
+                                    sites=sites,
+                                    accepted=True,
+                                    catalog=catalog,
+                                    mimeTypes=mimeTypes,
+                                    accepted_after=accepted_after,
+                                    accepted_before=accepted_before)
+    return len(doc_ids or ())
+
+
+def count_expired_invitations(receivers=None,
+                              senders=None,
+                              sites=None,
+                              now=None,
+                              catalog=None,
+                              mimeTypes=None):
+    """
+    Return the number of expired invitations. Only the catalog
+    is consulted; no invitation object is loaded.
+    """
+    doc_ids = get_expired_invitation_ids(receivers=receivers,
+                                         senders=senders,
+                                         sites=sites,
+                                         now=now,
+                                         catalog=catalog,
+                                         mimeTypes=mimeTypes)
+    return len(doc_ids or ())
+
+
+def count_sent_invitations(senders,
+                           sites=None,
+                           accepted=False,
+                           catalog=None,
+                           mimeTypes=None):
+    """
+    Return the number of invitations sent by the given senders. Only
+    the catalog is consulted; no invitation object is loaded.
+    """
     doc_ids = get_sent_invitation_ids(senders,
                                       sites,
                                       accepted,
                                       catalog,
                                       mimeTypes)
-    for uid in doc_ids or ():
-        obj = intids.queryObject(uid)
-        if is_actionable(obj):
-            result.append(obj)
+    return len(doc_ids or ())
+
+
+def _accept_invitation(user, invitation, get_actor, now=None):
+    with timed(METRIC_ACCEPT) as metrics:
+        if invitation.is_expired(now):
+            raise InvitationExpiredError(invitation)
+        actor = get_actor(invitation, user)
+        if actor is None:
+            raise InvitationActorError(invitation)
+        result = False
+        if actor.accept(user, invitation):
+            # not is_accepted(), a stored accepted flag may shadow the time
+            was_accepted = invitation.acceptedTime is not None
+            invitation.acceptedTime = time.time() if not now else now
+            invitation.receiver = getattr(user, 'username', user)  # update
+            notify(InvitationAcceptedEvent(invitation, user, was_accepted))
+            metrics.incr(METRIC_ACCEPTED)
+            result = True
     return result
 
 
 def accept_invitation(user, invitation):
-    if invitation.is_expired():
-        raise InvitationExpiredError(invitation)
-    actor = get_invitation_actor(invitation, user)
-    if actor is None:
-        raise InvitationActorError(invitation)
-    result = False
-    if actor.accept(user, invitation):
-        invitation.acceptedTime = time.time()
-        invitation.receiver = getattr(user, 'username', user)  # update
-        notify(InvitationAcceptedEvent(invitation, user))
-        result = True
+    return _accept_invitation(user, invitation, get_invitation_actor)
+
+
+class InvitationActorLookup(object):
+    """
+    Finds invitation actors like :func:`get_invitation_actor`, caching
+    the adapter factories by the interfaces provided by the invitation
+    and the user.
+    """
+
+    def __init__(self, registry=None):
+        self.registry = component.getSiteManager() if registry is None else registry
+        self._cache = dict()
+
+    def __call__(self, invitation, user=None):
+        key = (interface.providedBy(invitation), interface.providedBy(user))
+        try:
+            multi, single = self._cache[key]
+        except KeyError:
+            lookup = self.registry.adapters.lookup
+            multi = lookup(key, IInvitationActor)
+            single = lookup(key[:1], IInvitationActor)
+            self._cache[key] = multi, single
+        actor = multi(invitation, user) if multi is not None else None
+        if actor is None and IInvitationActor.providedBy(invitation):
+            actor = invitation
+        if actor is None and single is not None:
+            actor = single(invitation)
+        return actor
+
+
+def accept_invitations(pairs, now=None):
+    """
+    Accept invitations in bulk, e.g. for roster provisioning.
+
+    :param pairs: An iterable of ``(user, invitation)`` tuples.
+    :param now: The time used to check the expiration of all
+        the invitations and to set their accepted time.
+    :return: A list of ``(invitation, result)`` tuples, where ``result``
+        is the value :func:`accept_invitation` would return or the
+        :class:`InvitationValidationError` it would raise. A failure
+        does not stop the acceptance of the remaining invitations.
+    """
+    now = time.time() if not now else now
+    get_actor = InvitationActorLookup()
+    result = []
+    for user, invitation in pairs:
+        try:
+            accepted = _accept_invitation(user, invitation, get_actor, now)
+        except InvitationValidationError as e:
+            accepted = e
+        result.append((invitation, accepted))
     return result
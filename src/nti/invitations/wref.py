@@ -8,11 +8,17 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import threading
 from functools import total_ordering
 
 from zope import component
 from zope import interface
 
+from zope.component.hooks import getSite
+
+from zope.interface.interfaces import IRegistrationEvent
+from zope.interface.interfaces import IUtilityRegistration
+
 from nti.invitations.interfaces import IInvitation
 from nti.invitations.interfaces import IInvitationsContainer
 
@@ -25,6 +31,40 @@ from nti.wref.interfaces import IWeakRef
 logger = __import__('logging').getLogger(__name__)
 
 
+class _ContainerCache(threading.local):
+    key = None
+    container = None
+
+_container_cache = _ContainerCache()
+
+
+def get_invitations_container():
+    """
+    Return the :class:`IInvitationsContainer` of the current site.
+
+    The lookup is cached per thread until the current site or the
+    utility registrations of its site manager change.
+    """
+    site = getSite()
+    utilities = component.getSiteManager().utilities
+    key = (site, utilities, getattr(utilities, '_generation', None))
+    cache = _container_cache
+    if cache.container is None or cache.key != key:
+        cache.container = component.getUtility(IInvitationsContainer)
+        cache.key = key
+    return cache.container
+
+
+def clear_invitations_container_cache():
+    _container_cache.key = _container_cache.container = None
+
+
+@component.adapter(IUtilityRegistration, IRegistrationEvent)
+def _on_utility_registration(registration, unused_event=None):
+    if registration.provided.isOrExtends(IInvitationsContainer):
+        clear_invitations_container_cache()
+
+
 @total_ordering
 @EqHash('_code')
 @component.adapter(IInvitation)
@@ -39,7 +79,7 @@ class InvitationWeakRef(object):
         self._code = invitation.code
 
     def __call__(self):
-        container = component.getUtility(IInvitationsContainer)
+        container = get_invitations_container()
         return container.get_invitation_by_code(self._code)
 
     def __getstate__(self):
@@ -62,3 +102,20 @@ class InvitationWeakRef(object):
     def __repr__(self):
         return "%s(%s)" % (self.__class__.__name__,
                            self._code)
+
+
+def resolve_many(refs):
+    """
+    Dereference the given invitation weak refs at once. The container
+    is looked up once and walked in code order.
+
+    :return: The invitations, or None for the missing ones, in the
+        order of ``refs``.
+    """
+    refs = list(refs)
+    container = get_invitations_container()
+    codes = set(ref.code for ref in refs)
+    found = dict()
+    for code in sorted(codes, key=lambda x: x.lower()):
+        found[code] = container.get_invitation_by_code(code)
+    return [found[ref.code] for ref in refs]